@@ -0,0 +1,178 @@
+from array import array
+from bisect import bisect_left
+import struct
+import sys
+from typing import Iterator, Mapping
+
+# attribute values are either a string or a list of strings (multi-valued
+# attributes such as class); the lowest bit of an encoded value tells which
+_LIST_FLAG = 1
+
+
+class AttrTable(Mapping[int, dict]):
+    """
+    Compact `{node_id: {attr: value}}` mapping.
+
+    Attribute names and values are interned in a string table, and nodes are
+    stored as rows of (name, value) index pairs in flat arrays. `get` returns
+    a new dict every time, so callers may modify it.
+    """
+
+    __slots__ = ("_strings", "_lists", "_node_ids", "_offsets", "_items")
+
+    def __init__(self, strings: list[str], lists: list[tuple[int, ...]], node_ids: array, offsets: array, items: array):
+        self._strings = strings
+        self._lists = lists
+        self._node_ids = node_ids
+        self._offsets = offsets
+        self._items = items
+
+    @classmethod
+    def from_dict(cls, attrs: Mapping[int, dict]) -> "AttrTable":
+        builder = AttrTableBuilder()
+        for node_id in sorted(attrs):
+            builder.add(node_id, attrs[node_id])
+        return builder.build()
+
+    def to_dict(self) -> dict[int, dict]:
+        return {node_id: self[node_id] for node_id in self}
+
+    def _row(self, node_id: int) -> int:
+        row = bisect_left(self._node_ids, node_id)
+        if row == len(self._node_ids) or self._node_ids[row] != node_id:
+            raise KeyError(node_id)
+        return row
+
+    def __getitem__(self, node_id: int) -> dict:
+        row = self._row(node_id)
+        strings = self._strings
+        result = {}
+        items = self._items
+        for i in range(self._offsets[row], self._offsets[row + 1], 2):
+            value = items[i + 1]
+            if value & _LIST_FLAG:
+                result[strings[items[i]]] = [strings[s] for s in self._lists[value >> 1]]
+            else:
+                result[strings[items[i]]] = strings[value >> 1]
+        return result
+
+    def __contains__(self, node_id) -> bool:
+        try:
+            self._row(node_id)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._node_ids)
+
+    def __len__(self) -> int:
+        return len(self._node_ids)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Mapping):
+            return self.to_dict() == dict(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"AttrTable({len(self)} nodes, {len(self._strings)} strings)"
+
+    def to_bytes(self) -> bytes:
+        encoded_strings = [s.encode() for s in self._strings]
+        list_offsets = array("I", [0])
+        list_items = array("I")
+        for values in self._lists:
+            list_items.extend(values)
+            list_offsets.append(len(list_items))
+
+        parts = [
+            _pack_array(array("I", [len(s) for s in encoded_strings])),
+            b"".join(encoded_strings),
+            _pack_array(list_offsets),
+            _pack_array(list_items),
+            _pack_array(self._node_ids),
+            _pack_array(self._offsets),
+            _pack_array(self._items),
+        ]
+        return b"".join(struct.pack("<I", len(part)) + part for part in parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes | memoryview) -> "AttrTable":
+        data = memoryview(data)
+        parts = []
+        pos = 0
+        for _ in range(7):
+            (size,) = struct.unpack_from("<I", data, pos)
+            pos += 4
+            parts.append(data[pos:pos + size])
+            pos += size
+        string_lengths, string_data, list_offsets, list_items, node_ids, offsets, items = parts
+
+        strings = []
+        start = 0
+        for length in _unpack_array(string_lengths):
+            strings.append(str(string_data[start:start + length], "utf-8"))
+            start += length
+
+        list_offsets = _unpack_array(list_offsets)
+        list_items = _unpack_array(list_items)
+        lists = [tuple(list_items[list_offsets[i]:list_offsets[i + 1]]) for i in range(len(list_offsets) - 1)]
+
+        return cls(strings, lists, _unpack_array(node_ids), _unpack_array(offsets), _unpack_array(items))
+
+
+class AttrTableBuilder:
+    def __init__(self):
+        self._strings: list[str] = []
+        self._string_index: dict[str, int] = {}
+        self._lists: list[tuple[int, ...]] = []
+        self._list_index: dict[tuple[int, ...], int] = {}
+        self._node_ids = array("I")
+        self._offsets = array("I", [0])
+        self._items = array("I")
+
+    def _intern(self, s: str) -> int:
+        index = self._string_index.get(s)
+        if index is None:
+            index = self._string_index[s] = len(self._strings)
+            self._strings.append(s)
+        return index
+
+    def _intern_list(self, values: list[str]) -> int:
+        key = tuple(self._intern(v) for v in values)
+        index = self._list_index.get(key)
+        if index is None:
+            index = self._list_index[key] = len(self._lists)
+            self._lists.append(key)
+        return index
+
+    def add(self, node_id: int, attrs: dict):
+        # node ids must be added in increasing order
+        if self._node_ids and node_id <= self._node_ids[-1]:
+            raise ValueError(f"node id out of order: {node_id}")
+        for name, value in attrs.items():
+            self._items.append(self._intern(name))
+            if isinstance(value, str):
+                self._items.append(self._intern(value) << 1)
+            else:
+                self._items.append(self._intern_list(value) << 1 | _LIST_FLAG)
+        self._node_ids.append(node_id)
+        self._offsets.append(len(self._items))
+
+    def build(self) -> AttrTable:
+        return AttrTable(self._strings, self._lists, self._node_ids, self._offsets, self._items)
+
+
+def _pack_array(a: array) -> bytes:
+    if sys.byteorder == "big":
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def _unpack_array(data: memoryview) -> array:
+    a = array("I")
+    a.frombytes(data)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
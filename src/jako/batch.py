@@ -0,0 +1,207 @@
+import argparse
+import asyncio
+import json
+import os
+from pathlib import Path
+import time
+from typing import Iterator
+
+import requests
+from google.genai import types
+
+from jako.cache import BaseCache, SharedCache, cache_key, open_shared_cache
+from jako.llm import CACHE_SCOPE, GoogleGenaiClient, encode_response
+from jako.models.page import PageData
+from jako.preprocessed import artifact_path_for
+from jako.translate import SYSTEM_PROMPT, TEMPERATURE, build_chunk_args, main as translate_main, open_cache, preprocess, read_input_paths, result_path_for
+
+API_URL = "https://generativelanguage.googleapis.com"
+
+# inline batch requests are limited to 20MB per job
+MAX_JOB_BYTES = 16 * 1024 * 1024
+
+TERMINAL_STATES = {
+    "BATCH_STATE_SUCCEEDED",
+    "BATCH_STATE_FAILED",
+    "BATCH_STATE_CANCELLED",
+    "BATCH_STATE_EXPIRED",
+}
+
+
+class GeminiBatchClient:
+    # https://ai.google.dev/gemini-api/docs/batch-mode
+
+    def __init__(self, api_key: str | None = None, base_url: str = API_URL):
+        self._base_url = base_url.rstrip("/")
+        self._session = requests.Session()
+        self._session.headers["x-goog-api-key"] = api_key or os.environ["GEMINI_API_KEY"]
+
+    def _call(self, method: str, path: str, **kwargs) -> dict:
+        response = self._session.request(method, f"{self._base_url}/v1beta/{path}", **kwargs)
+        if not response:
+            print(f"error response: {response.text}")
+            response.raise_for_status()
+        return response.json()
+
+    def create(self, model: str, requests: list[tuple[str, dict]], display_name: str) -> str:
+        data = self._call("POST", f"models/{model}:batchGenerateContent", json={
+            "batch": {
+                "display_name": display_name,
+                "input_config": {
+                    "requests": {
+                        "requests": [
+                            {"request": request, "metadata": {"key": key}}
+                            for key, request in requests
+                        ],
+                    },
+                },
+            },
+        })
+        return data["name"]
+
+    def get(self, name: str) -> dict:
+        return self._call("GET", name)
+
+    def wait_all(self, names: list[str], poll_interval: float) -> Iterator[dict]:
+        # yields the jobs as they finish, so that they run concurrently
+        pending = list(names)
+        while True:
+            for name in list(pending):
+                job = self.get(name)
+                state = job.get("metadata", {}).get("state")
+                print(f"batch {name}: {state}")
+                if job.get("done") or state in TERMINAL_STATES:
+                    pending.remove(name)
+                    yield job
+            if not pending:
+                return
+            time.sleep(poll_interval)
+
+
+def to_rest_request(contents: str, config: dict) -> dict:
+    return {
+        "contents": [{"role": "user", "parts": [{"text": contents}]}],
+        "systemInstruction": {"parts": [{"text": config["system_instruction"]}]},
+        "generationConfig": {
+            "maxOutputTokens": config["max_output_tokens"],
+            "temperature": config["temperature"],
+        },
+    }
+
+
+def iter_job_responses(job: dict):
+    state = job.get("metadata", {}).get("state")
+    if state != "BATCH_STATE_SUCCEEDED":
+        raise Exception(f"batch {job['name']} did not succeed: {state} {job.get('error')}")
+
+    for item in job["response"]["inlinedResponses"]["inlinedResponses"]:
+        key = item["metadata"]["key"]
+        if "error" in item:
+            print(f"batch request {key} failed: {item['error']}")
+            continue
+        yield key, types.GenerateContentResponse.model_validate(item["response"])
+
+
+def prefill_cache(input_paths: list[Path], client: GeminiBatchClient, overwrite: bool = False, poll_interval: float = 60):
+    """
+    Translates every uncached chunk of the given pages with the Batch API and
+    stores the responses in the shared cache, so that `translate.process`
+    finds them there and only restores the pages.
+    """
+    cache = open_shared_cache()
+    try:
+        _prefill_cache(input_paths, client, cache, overwrite, poll_interval)
+    finally:
+        cache.close()
+
+
+def _prefill_cache(input_paths: list[Path], client: GeminiBatchClient, cache: SharedCache, overwrite: bool, poll_interval: float):
+    pending: list[dict] = []
+    pending_keys = set()
+    for input_path in input_paths:
+        if result_path_for(input_path).exists() and not overwrite:
+            continue
+        data = PageData.model_validate_json(input_path.read_text())
+        page_cache = open_cache(data, cache)
+        chunks = [chunk for section in preprocess(data, artifact_path_for(input_path)) for chunk in section.chunks]
+        page_pending = 0
+        for args in build_chunk_args(data, chunks, GoogleGenaiClient.default_model):
+            kwargs = GoogleGenaiClient.request_kwargs(
+                model=args["model"],
+                prompt=args["prompt"],
+                system_instruction=SYSTEM_PROMPT,
+                max_output_tokens=args["max_output_tokens"],
+                temperature=TEMPERATURE,
+            )
+            key = cache_key(CACHE_SCOPE, (), kwargs)
+            if key in pending_keys or page_cache.get_encoded(key)[1]:
+                continue
+            pending.append(kwargs)
+            pending_keys.add(key)
+            page_pending += 1
+        print(f"{input_path}: {page_pending}/{len(chunks)} chunks pending")
+
+    if not pending:
+        return
+
+    # create all jobs before waiting for any, so that they are processed together
+    jobs: dict[str, list[dict]] = {}
+    for model in sorted({kwargs["model"] for kwargs in pending}):
+        for job_requests in _split_jobs([kwargs for kwargs in pending if kwargs["model"] == model]):
+            name = client.create(model, [
+                (str(i), to_rest_request(kwargs["contents"], kwargs["config"]))
+                for i, kwargs in enumerate(job_requests)
+            ], display_name=f"jako-{model}-{int(time.time())}-{len(jobs)}")
+            print(f"Created batch {name} with {len(job_requests)} requests")
+            jobs[name] = job_requests
+
+    for job in client.wait_all(list(jobs), poll_interval):
+        try:
+            _store_responses(cache, job, jobs[job["name"]])
+        except Exception as e:
+            # the other jobs are still stored; these chunks are translated online
+            print(e)
+
+
+def _split_jobs(requests: list[dict]):
+    job = []
+    job_bytes = 0
+    for kwargs in requests:
+        size = len(json.dumps(kwargs, ensure_ascii=False).encode())
+        if job and job_bytes + size > MAX_JOB_BYTES:
+            yield job
+            job = []
+            job_bytes = 0
+        job.append(kwargs)
+        job_bytes += size
+    if job:
+        yield job
+
+
+def _store_responses(cache: BaseCache, job: dict, job_requests: list[dict]):
+    stored = 0
+    for key, response in iter_job_responses(job):
+        candidate = response.candidates[0] if response.candidates else None
+        if candidate is None or candidate.finish_reason != "STOP":
+            # leave it to the online path, which will retry
+            continue
+        cache.set(CACHE_SCOPE, (), job_requests[int(key)], response, encode_response)
+        stored += 1
+    cache.flush()
+    print(f"Stored {stored}/{len(job_requests)} batch responses")
+
+
+def main(args):
+    input_paths = read_input_paths(Path(args.input))
+    prefill_cache(input_paths, GeminiBatchClient(), overwrite=args.overwrite, poll_interval=args.poll_interval)
+    # restore pages from the cache; chunks that failed in the batch are translated online
+    asyncio.run(translate_main(args, GoogleGenaiClient()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="Input file")
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--poll-interval", type=float, default=60)
+    parser.set_defaults(preprocess_only=False, refresh=False)
+    main(parser.parse_args())
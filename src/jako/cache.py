@@ -1,8 +1,16 @@
+from abc import ABC, abstractmethod
 import asyncio
+from datetime import timedelta
+import hashlib
 import json
+import os
 from pathlib import Path
+import sqlite3
+import time
 from typing import Callable, TypedDict
 
+from jako.files import append_lines_locked
+
 
 class CacheEntry(TypedDict):
     args: list
@@ -10,13 +18,16 @@ class CacheEntry(TypedDict):
     result: object
 
 
-class Cache:
-    _path: Path
-    _data: dict[str, list[CacheEntry]]
+def cache_key(scope: str, args: tuple | list, kwargs: dict) -> str:
+    payload = json.dumps([scope, list(args), kwargs], sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
 
-    def __init__(self, path: Path):
-        self._path = path
-        self._data = json.loads(path.read_text()) if path.exists() else {}
+
+class BaseCache(ABC):
+    _inflight: dict[str, asyncio.Future]
+
+    def __init__(self):
+        self._inflight = {}
 
     def wrap(self, scope: str, func: Callable, encode_result: Callable, decode_result: Callable):
         if asyncio.iscoroutinefunction(func):
@@ -24,10 +35,31 @@ class Cache:
                 cached, found = self.lookup(scope, args, kwargs, decode_result)
                 if found:
                     return cached
-                result = await func(*args, **kwargs)
-                self.set(scope, args, kwargs, result, encode_result)
-                self.flush()
-                return result
+
+                # single-flight: identical concurrent calls share one request
+                key = cache_key(scope, args, kwargs)
+                inflight = self._inflight.get(key)
+                if inflight is not None:
+                    return await asyncio.shield(inflight)
+
+                future = asyncio.get_running_loop().create_future()
+                future.add_done_callback(_consume_future_exception)
+                self._inflight[key] = future
+                try:
+                    result = await func(*args, **kwargs)
+                    self.set(scope, args, kwargs, result, encode_result)
+                    self.flush()
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except BaseException as e:
+                    future.set_exception(e)
+                    raise
+                else:
+                    future.set_result(result)
+                    return result
+                finally:
+                    del self._inflight[key]
         else:
             def wrapper(*args, **kwargs):
                 cached, found = self.lookup(scope, args, kwargs, decode_result)
@@ -40,19 +72,227 @@ class Cache:
         return wrapper
 
     def lookup(self, scope: str, args: tuple, kwargs: dict, decode_result: Callable):
-        for entry in self._data.get(scope, []):
-            if entry["args"] == list(args) and entry["kwargs"] == kwargs:
-                return decode_result(entry["result"]), True
+        encoded, found = self.get_encoded(cache_key(scope, args, kwargs))
+        if found:
+            return decode_result(encoded), True
         return None, False
-    
+
     def set(self, scope: str, args: tuple, kwargs: dict, result: object, encode_result: Callable):
-        if scope not in self._data:
-            self._data[scope] = []
-        self._data[scope].append({
-            "args": args,
+        self.set_encoded(cache_key(scope, args, kwargs), scope, args, kwargs, encode_result(result))
+
+    @abstractmethod
+    def get_encoded(self, key: str) -> tuple[object, bool]: ...
+
+    @abstractmethod
+    def set_encoded(self, key: str, scope: str, args: tuple | list, kwargs: dict, encoded: object): ...
+
+    def flush(self):
+        pass
+
+
+class Cache(BaseCache):
+    """
+    Append-only JSONL cache indexed by `cache_key`.
+
+    Entries are appended to `<name>.jsonl`; a legacy `<name>.json` file
+    (`{scope: [CacheEntry, ...]}`) next to it is loaded read-only.
+    """
+
+    _path: Path
+    _index: dict[str, object]
+    _pending: list[str]
+    _log_offset: int
+
+    def __init__(self, path: Path):
+        super().__init__()
+        self._path = path.with_suffix(".jsonl")
+        self._index = {}
+        self._pending = []
+        self._log_offset = 0
+
+        legacy_path = path.with_suffix(".json")
+        if legacy_path.exists():
+            self._load_legacy(legacy_path)
+        self._load_log()
+
+    def _load_legacy(self, path: Path):
+        data: dict[str, list[CacheEntry]] = json.loads(path.read_text())
+        for scope, entries in data.items():
+            for entry in entries:
+                key = cache_key(scope, entry["args"], entry["kwargs"])
+                # first entry wins, same as the old linear scan
+                self._index.setdefault(key, entry["result"])
+
+    def _load_log(self):
+        # reads entries appended since the last load (possibly by other processes)
+        try:
+            with self._path.open("rb") as f:
+                f.seek(self._log_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # an incomplete last line is either being written or torn by a crash
+        end = data.rfind(b"\n") + 1
+        self._log_offset += end
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping broken cache line in {self._path}")
+                continue
+            self._index[record["key"]] = record["result"]
+
+    def get_encoded(self, key: str):
+        if key not in self._index:
+            self._load_log()
+        if key in self._index:
+            return self._index[key], True
+        return None, False
+
+    def set_encoded(self, key, scope, args, kwargs, encoded):
+        self._index[key] = encoded
+        self._pending.append(json.dumps({
+            "key": key,
+            "scope": scope,
+            "args": list(args),
             "kwargs": kwargs,
-            "result": encode_result(result),
-        })
-    
+            "result": encoded,
+        }, ensure_ascii=False))
+
+    def flush(self):
+        if not self._pending:
+            return
+        append_lines_locked(self._path, self._pending)
+        self._pending.clear()
+
+
+class SharedCache(BaseCache):
+    """
+    Content-addressed cache shared by all pages and worker processes (SQLite).
+
+    Entries older than `ttl` are dropped, and least recently used entries are
+    evicted once the stored results exceed `max_bytes`.
+    """
+
+    EVICT_INTERVAL = 100  # sets
+
+    def __init__(self, path: Path, max_bytes: int | None = None, ttl: timedelta | None = None):
+        super().__init__()
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._sets_since_evict = 0
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                scope TEXT NOT NULL,
+                result TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+        self.evict()
+
+    def close(self):
+        self._conn.close()
+
+    def get_encoded(self, key: str):
+        row = self._conn.execute("SELECT result, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, False
+        result, created_at = row
+        now = time.time()
+        if self._ttl is not None and created_at < now - self._ttl.total_seconds():
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None, False
+        self._conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(result), True
+
+    def set_encoded(self, key, scope, args, kwargs, encoded):
+        result = json.dumps(encoded, ensure_ascii=False)
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO entries (key, scope, result, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, scope, result, len(result.encode()), now, now),
+        )
+        self._sets_since_evict += 1
+
+    def flush(self):
+        if self._sets_since_evict >= self.EVICT_INTERVAL:
+            self.evict()
+
+    def evict(self):
+        self._sets_since_evict = 0
+        if self._ttl is not None:
+            self._conn.execute("DELETE FROM entries WHERE created_at < ?", (time.time() - self._ttl.total_seconds(),))
+        if self._max_bytes is None:
+            return
+
+        (total,) = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+        if total <= self._max_bytes:
+            return
+        # evict down to 90% of the budget so that we don't evict on every set
+        to_free = total - self._max_bytes * 0.9
+        keys = []
+        for key, size in self._conn.execute("SELECT key, size FROM entries ORDER BY accessed_at"):
+            keys.append((key,))
+            to_free -= size
+            if to_free <= 0:
+                break
+        self._conn.executemany("DELETE FROM entries WHERE key = ?", keys)
+
+
+class TieredCache(BaseCache):
+    """
+    Looks up each cache in order and writes only to the first one.
+    Hits from later caches are copied into the first one.
+    """
+
+    def __init__(self, caches: list[BaseCache]):
+        super().__init__()
+        self._caches = caches
+        # pages that write to the same cache also share its in-flight calls
+        self._inflight = caches[0]._inflight
+
+    def lookup(self, scope: str, args: tuple, kwargs: dict, decode_result: Callable):
+        key = cache_key(scope, args, kwargs)
+        for i, cache in enumerate(self._caches):
+            encoded, found = cache.get_encoded(key)
+            if found:
+                if i > 0:
+                    self._caches[0].set_encoded(key, scope, args, kwargs, encoded)
+                return decode_result(encoded), True
+        return None, False
+
+    def get_encoded(self, key: str):
+        for cache in self._caches:
+            encoded, found = cache.get_encoded(key)
+            if found:
+                return encoded, True
+        return None, False
+
+    def set_encoded(self, key, scope, args, kwargs, encoded):
+        self._caches[0].set_encoded(key, scope, args, kwargs, encoded)
+
     def flush(self):
-        self._path.write_text(json.dumps(self._data, indent=2, ensure_ascii=False))
+        self._caches[0].flush()
+
+
+def _consume_future_exception(future: asyncio.Future):
+    # avoid "exception was never retrieved" warnings when nobody was waiting
+    if not future.cancelled():
+        future.exception()
+
+
+def open_shared_cache() -> SharedCache:
+    path = Path(os.environ.get("JAKO_SHARED_CACHE_PATH", "data/cache/shared.sqlite3"))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    ttl_days = int(os.environ.get("JAKO_SHARED_CACHE_TTL_DAYS", "180"))
+    return SharedCache(
+        path,
+        max_bytes=int(os.environ.get("JAKO_SHARED_CACHE_MAX_BYTES", str(2 * 1024 ** 3))),
+        ttl=timedelta(days=ttl_days) if ttl_days > 0 else None,
+    )
@@ -0,0 +1,54 @@
+from contextlib import contextmanager
+import fcntl
+import os
+from pathlib import Path
+import tempfile
+from typing import BinaryIO, Iterator
+
+
+def atomic_write_text(path: Path, text: str):
+    atomic_write_bytes(path, text.encode("utf-8"))
+
+
+def atomic_write_bytes(path: Path, data: bytes):
+    with atomic_writer(path) as f:
+        f.write(data)
+
+
+@contextmanager
+def atomic_writer(path: Path) -> Iterator[BinaryIO]:
+    # write to a temp file in the same directory, then rename over the target,
+    # so readers never see a partially written file
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        # mkstemp creates the file as 0600
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def append_lines_locked(path: Path, lines: list[str]):
+    with path.open("ab") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            data = "".join(line + "\n" for line in lines).encode()
+            # a writer that crashed mid-line leaves no trailing newline;
+            # start on a fresh line so that only the torn line is lost
+            size = f.seek(0, os.SEEK_END)
+            if size > 0:
+                with path.open("rb") as r:
+                    r.seek(size - 1)
+                    if r.read(1) != b"\n":
+                        data = b"\n" + data
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
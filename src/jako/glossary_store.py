@@ -0,0 +1,78 @@
+from datetime import timedelta
+from itertools import batched
+import os
+from pathlib import Path
+import sqlite3
+import time
+from typing import Iterable
+
+from jako.models.page import Langlink, PageLanglinks
+
+
+class GlossaryStore:
+    """
+    ko langlinks of ja pages, shared by all pages and worker processes (SQLite).
+
+    Pages without a ko langlink are stored too, so that they aren't looked up
+    again until they are older than `max_age`.
+    """
+
+    def __init__(self, path: Path, max_age: timedelta | None = None):
+        self._max_age = max_age
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS langlinks (
+                title TEXT PRIMARY KEY,
+                pageid INTEGER NOT NULL,
+                ns INTEGER NOT NULL,
+                ko_title TEXT,
+                fetched_at REAL NOT NULL
+            )
+        """)
+
+    def close(self):
+        self._conn.close()
+
+    def get_many(self, titles: Iterable[str]) -> dict[str, PageLanglinks]:
+        # titles that are not stored or are stale are left out
+        min_fetched_at = time.time() - self._max_age.total_seconds() if self._max_age is not None else 0
+        result = {}
+        # stay under SQLite's limit of bound parameters
+        for batch in batched(titles, 500):
+            rows = self._conn.execute(
+                f"SELECT title, pageid, ns, ko_title FROM langlinks WHERE fetched_at >= ? AND title IN ({','.join('?' * len(batch))})",
+                (min_fetched_at, *batch),
+            )
+            for title, pageid, ns, ko_title in rows:
+                result[title] = PageLanglinks(
+                    pageid=pageid,
+                    ns=ns,
+                    title=title,
+                    langlinks=[Langlink(lang="ko", title=ko_title)] if ko_title is not None else None,
+                )
+        return result
+
+    def get_ko_titles(self, titles: Iterable[str]) -> dict[str, str | None]:
+        return {
+            title: link.langlinks[0].title if link.langlinks else None
+            for title, link in self.get_many(titles).items()
+        }
+
+    def put_many(self, links: Iterable[PageLanglinks]):
+        now = time.time()
+        rows = []
+        for link in links:
+            ko_titles = [langlink.title for langlink in link.langlinks or [] if langlink.lang == "ko"]
+            rows.append((link.title, link.pageid, link.ns, ko_titles[0] if ko_titles else None, now))
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO langlinks (title, pageid, ns, ko_title, fetched_at) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+
+
+def open_glossary_store() -> GlossaryStore:
+    path = Path(os.environ.get("JAKO_GLOSSARY_STORE_PATH", "data/glossary.sqlite3"))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    max_age_days = int(os.environ.get("JAKO_GLOSSARY_MAX_AGE_DAYS", "30"))
+    return GlossaryStore(path, max_age=timedelta(days=max_age_days) if max_age_days > 0 else None)
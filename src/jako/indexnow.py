@@ -0,0 +1,138 @@
+from datetime import timedelta
+from itertools import batched
+import os
+from pathlib import Path
+import sqlite3
+import time
+from typing import Callable, Iterable
+
+import requests
+
+from jako.ratelimit import backoff_delay
+
+# https://www.indexnow.org/documentation
+MAX_URLS_PER_REQUEST = 10_000
+
+
+def indexnow_batch(urls: list[str]):
+    resp = requests.post("https://api.indexnow.org/indexnow", json={
+        "host": "jako.sapzil.org",
+        "key": "198c6938537a4c3185af9ff04fa38082",
+        "keyLocation": "https://jako.sapzil.org/indexnowkey",
+        "urlList": urls,
+    })
+    if not resp.ok:
+        print(resp.content)
+        resp.raise_for_status()
+
+
+class IndexNowQueue:
+    """
+    URLs waiting to be submitted to IndexNow, shared by worker processes
+    (SQLite), so that they survive restarts and duplicates are submitted once.
+
+    `flush_if_due` submits them in requests of up to 10,000 URLs once
+    `flush_size` URLs are pending or the oldest one has waited for
+    `flush_interval`. Failed submissions are retried with backoff.
+    """
+
+    LEASE_SECONDS = 10 * 60
+
+    def __init__(
+        self,
+        path: Path,
+        submit: Callable[[list[str]], None] = indexnow_batch,
+        flush_size: int = MAX_URLS_PER_REQUEST,
+        flush_interval: timedelta = timedelta(minutes=10),
+    ):
+        self._submit = submit
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS pending (url TEXT PRIMARY KEY, queued_at REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pending_queued_at ON pending (queued_at)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value REAL NOT NULL)")
+
+    def close(self):
+        self._conn.close()
+
+    def add(self, urls: Iterable[str]):
+        now = time.time()
+        self._conn.executemany("INSERT OR IGNORE INTO pending (url, queued_at) VALUES (?, ?)", ((url, now) for url in urls))
+
+    def pending_count(self) -> int:
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM pending").fetchone()
+        return count
+
+    def _get_state(self, key: str) -> float:
+        row = self._conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def _set_state(self, key: str, value: float):
+        self._conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+    def is_due(self) -> bool:
+        now = time.time()
+        if now < self._get_state("retry_at"):
+            return False
+        (count, oldest) = self._conn.execute("SELECT COUNT(*), MIN(queued_at) FROM pending").fetchone()
+        if not count:
+            return False
+        return count >= self._flush_size or oldest <= now - self._flush_interval.total_seconds()
+
+    def flush_if_due(self) -> int:
+        if not self.is_due():
+            return 0
+        return self.flush()
+
+    def flush(self) -> int:
+        """
+        Submits all pending URLs and returns how many were submitted. On a
+        failure, the rest stay pending and the next flush is delayed.
+        """
+        if not self._acquire_lease():
+            print("IndexNow queue is being flushed by another process")
+            return 0
+        try:
+            return self._flush()
+        finally:
+            self._set_state("lease", 0)
+
+    def _acquire_lease(self) -> bool:
+        # expires in case the holder died while flushing
+        now = time.time()
+        cursor = self._conn.execute(
+            "INSERT INTO state (key, value) VALUES ('lease', ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value WHERE value < ?",
+            (now + self.LEASE_SECONDS, now),
+        )
+        return cursor.rowcount > 0
+
+    def _flush(self) -> int:
+        urls = [url for (url,) in self._conn.execute("SELECT url FROM pending ORDER BY queued_at, url")]
+        submitted = 0
+        for chunk in batched(urls, MAX_URLS_PER_REQUEST):
+            try:
+                self._submit(list(chunk))
+            except Exception as e:
+                failures = int(self._get_state("failures")) + 1
+                delay = max(60, backoff_delay(failures, base=60, cap=6 * 60 * 60))
+                self._set_state("failures", failures)
+                self._set_state("retry_at", time.time() + delay)
+                print(f"IndexNow submission failed ({e!r}), retrying in {delay:.0f} seconds")
+                break
+            self._conn.executemany("DELETE FROM pending WHERE url = ?", ((url,) for url in chunk))
+            self._set_state("failures", 0)
+            submitted += len(chunk)
+            print(f"Submitted {len(chunk)} URLs to IndexNow")
+        return submitted
+
+
+def open_indexnow_queue() -> IndexNowQueue:
+    path = Path(os.environ.get("JAKO_INDEXNOW_QUEUE_PATH", "data/worker/indexnow.sqlite3"))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return IndexNowQueue(
+        path,
+        flush_size=int(os.environ.get("JAKO_INDEXNOW_FLUSH_SIZE", str(MAX_URLS_PER_REQUEST))),
+        flush_interval=timedelta(seconds=int(os.environ.get("JAKO_INDEXNOW_FLUSH_INTERVAL", "600"))),
+    )
@@ -1,41 +1,172 @@
 import asyncio
+from dataclasses import dataclass
 import os
+import random
+import re
 import traceback
+from typing import Awaitable, Callable, Protocol
+
+import anthropic
 from google import genai
 from google.genai import types
 from google.genai.errors import APIError
+import openai
+
+from jako.cache import BaseCache
+from jako.ratelimit import AdaptiveLimiter, backoff_delay
+from jako.tokens import default_counter
+
+
+CACHE_SCOPE = "google"
+
+
+def encode_response(result: types.GenerateContentResponse):
+    return types.GenerateContentResponse.model_dump(result, mode="json")
+
+
+def decode_response(result) -> types.GenerateContentResponse:
+    if not result.get("parsed"):
+        result["parsed"] = {}  # workaround
+    return types.GenerateContentResponse(**result)
+
+
+@dataclass
+class Completion:
+    text: str
+    finish_reason: str
+    # False if the output was truncated or blocked
+    complete: bool
+
+
+class LLMClient(Protocol):
+    default_model: str
+    # used when the default model's output can't be restored
+    fallback_model: str
+
+    async def agenerate(
+        self,
+        *,
+        model: str,
+        prompt: str,
+        system_instruction: str,
+        max_output_tokens: int,
+        temperature: float,
+        cache: BaseCache,
+    ) -> Completion: ...
+
+
+_default_limiter: AdaptiveLimiter | None = None
+
+
+def default_limiter() -> AdaptiveLimiter:
+    # shared by all clients in the process
+    global _default_limiter
+    if _default_limiter is None:
+        _default_limiter = AdaptiveLimiter(
+            max_concurrency=int(os.environ.get("JAKO_LLM_MAX_CONCURRENCY", "8")),
+            requests_per_minute=float(os.environ.get("JAKO_LLM_RPM", "0")) or None,
+            tokens_per_minute=float(os.environ.get("JAKO_LLM_TPM", "0")) or None,
+        )
+    return _default_limiter
 
-from jako.cache import Cache
+
+async def _call_with_retry(
+    limiter: AdaptiveLimiter,
+    tokens: int,
+    call: Callable[[], Awaitable],
+    classify_error: Callable[[Exception], tuple[int, float | None] | None],
+):
+    # classify_error returns (status code, retry after) for retryable errors
+    for attempt in range(10):
+        try:
+            async with limiter.slot(tokens):
+                response = await call()
+            limiter.on_success()
+            return response
+        except Exception as e:
+            retryable = classify_error(e)
+            if retryable is None:
+                raise
+            status, retry_after = retryable
+            traceback.print_exc()
+            if status == 429:
+                limiter.on_throttled()
+            delay = max(backoff_delay(attempt), retry_after or 0)
+            print(f"Rate limit exceeded, retrying in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+    raise Exception("retry failed")
+
+
+def _estimate_tokens(contents) -> int:
+    # counted like chunk sizes and output budgets; `contents` is a prompt or a list of chat messages
+    if isinstance(contents, list):
+        return sum(_estimate_tokens(message["content"]) for message in contents)
+    return default_counter().count(contents)
+
+
+def _retry_after_header(response) -> float | None:
+    headers = getattr(response, "headers", None)
+    if headers:
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return None
 
 
 class GoogleGenaiClient:
     GenerateContentResponse = types.GenerateContentResponse
 
-    def __init__(self):
+    default_model = "gemini-2.0-flash-lite"
+    fallback_model = "gemini-2.0-flash"
+
+    def __init__(self, limiter: AdaptiveLimiter | None = None):
         self._client = genai.Client(api_key=os.environ["GEMINI_API_KEY"], http_options={"timeout": 60 * 5 * 1000})
-    
+        self._limiter = limiter or default_limiter()
+
+    @staticmethod
+    def request_kwargs(*, model: str, prompt: str, system_instruction: str, max_output_tokens: int, temperature: float) -> dict:
+        # cache keys are derived from these, so keep the shape stable
+        return {
+            "model": model,
+            "contents": prompt,
+            "config": {
+                "system_instruction": system_instruction,
+                "max_output_tokens": max_output_tokens,
+                "temperature": temperature,
+            },
+        }
+
+    async def agenerate(self, *, model, prompt, system_instruction, max_output_tokens, temperature, cache) -> Completion:
+        r = await self.agenerate_content(
+            **self.request_kwargs(
+                model=model,
+                prompt=prompt,
+                system_instruction=system_instruction,
+                max_output_tokens=max_output_tokens,
+                temperature=temperature,
+            ),
+            cache=cache,
+        )
+        finish_reason = r.candidates[0].finish_reason
+        return Completion(text=r.text or "", finish_reason=finish_reason or "", complete=finish_reason == "STOP")
+
     async def agenerate_content(
         self,
         *,
         model: str,
         contents: types.ContentListUnionDict,
         config: types.GenerateContentConfigOrDict | None = None,
-        cache: Cache,
-    ) -> types.GenerateContentResponse:  
-        def encode_result(result):
-            return types.GenerateContentResponse.model_dump(result, mode="json")
-        
-        def decode_result(result):
-            if not result.get("parsed"):
-                result["parsed"] = {}  # workaround
-            return types.GenerateContentResponse(**result)
-        
-        return await cache.wrap("google", self._agenerate_content_with_retry, encode_result, decode_result)(
+        cache: BaseCache,
+    ) -> types.GenerateContentResponse:
+        return await cache.wrap(CACHE_SCOPE, self._agenerate_content_with_retry, encode_response, decode_response)(
             model=model,
             contents=contents,
             config=config,
         )
-    
+
     async def _agenerate_content_with_retry(
         self,
         *,
@@ -43,18 +174,196 @@ class GoogleGenaiClient:
         contents: types.ContentListUnionDict,
         config: types.GenerateContentConfigOrDict | None = None,
     ) -> types.GenerateContentResponse:
-        for _ in range(10):
-            try:
-                return await self._client.aio.models.generate_content(
-                    model=model,
-                    contents=contents,
-                    config=config,
-                )
-            except APIError as e:
-                if e.code in (429, 503):
-                    traceback.print_exc()
-                    print("Rate limit exceeded, retrying in 10 seconds...")
-                    await asyncio.sleep(10)
-                    continue
-                raise
-        raise Exception("retry failed")
+        return await _call_with_retry(
+            self._limiter,
+            _estimate_tokens(contents),
+            lambda: self._client.aio.models.generate_content(
+                model=model,
+                contents=contents,
+                config=config,
+            ),
+            _classify_google_error,
+        )
+
+
+RETRY_DELAY_PATTERN = re.compile(r"^(\d+(?:\.\d+)?)s$")
+
+
+def _classify_google_error(e: Exception):
+    if isinstance(e, APIError) and e.code in (429, 503):
+        return e.code, _retry_after(e)
+    return None
+
+
+def _retry_after(e: APIError) -> float | None:
+    retry_after = _retry_after_header(e.response)
+    if retry_after is not None:
+        return retry_after
+
+    # Gemini reports it as google.rpc.RetryInfo in error details: {"retryDelay": "13s"}
+    response_json = getattr(e, "details", None)
+    if not isinstance(response_json, dict):
+        return None
+    for detail in response_json.get("error", {}).get("details", []):
+        match = RETRY_DELAY_PATTERN.match(str(detail.get("retryDelay", "")))
+        if match:
+            return float(match.group(1))
+    return None
+
+
+class OpenAIClient:
+    default_model = "gpt-4o-mini"
+    fallback_model = "gpt-4o"
+
+    def __init__(self, limiter: AdaptiveLimiter | None = None):
+        # retries are done by us so that they go through the limiter
+        self._client = openai.AsyncOpenAI(max_retries=0, timeout=60 * 5)
+        self._limiter = limiter or default_limiter()
+
+    async def agenerate(self, *, model, prompt, system_instruction, max_output_tokens, temperature, cache) -> Completion:
+        r: openai.types.chat.ChatCompletion = await cache.wrap(
+            "openai",
+            self._acreate_with_retry,
+            lambda result: result.model_dump(mode="json"),
+            openai.types.chat.ChatCompletion.model_validate,
+        )(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_instruction},
+                {"role": "user", "content": prompt},
+            ],
+            max_completion_tokens=max_output_tokens,
+            temperature=temperature,
+        )
+        choice = r.choices[0]
+        return Completion(text=choice.message.content or "", finish_reason=choice.finish_reason, complete=choice.finish_reason == "stop")
+
+    async def _acreate_with_retry(self, **kwargs) -> openai.types.chat.ChatCompletion:
+        return await _call_with_retry(
+            self._limiter,
+            _estimate_tokens(kwargs["messages"]),
+            lambda: self._client.chat.completions.create(**kwargs),
+            _classify_openai_error,
+        )
+
+
+def _classify_openai_error(e: Exception):
+    if isinstance(e, openai.APIStatusError) and e.status_code in (429, 503):
+        return e.status_code, _retry_after_header(e.response)
+    return None
+
+
+class AnthropicClient:
+    default_model = "claude-3-5-haiku-latest"
+    fallback_model = "claude-3-5-sonnet-latest"
+
+    def __init__(self, limiter: AdaptiveLimiter | None = None):
+        # retries are done by us so that they go through the limiter
+        self._client = anthropic.AsyncAnthropic(max_retries=0, timeout=60 * 5)
+        self._limiter = limiter or default_limiter()
+
+    async def agenerate(self, *, model, prompt, system_instruction, max_output_tokens, temperature, cache) -> Completion:
+        r: anthropic.types.Message = await cache.wrap(
+            "anthropic",
+            self._acreate_with_retry,
+            lambda result: result.model_dump(mode="json"),
+            anthropic.types.Message.model_validate,
+        )(
+            model=model,
+            system=system_instruction,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=max_output_tokens,
+            temperature=temperature,
+        )
+        text = "".join(block.text for block in r.content if block.type == "text")
+        return Completion(text=text, finish_reason=r.stop_reason or "", complete=r.stop_reason == "end_turn")
+
+    async def _acreate_with_retry(self, **kwargs) -> anthropic.types.Message:
+        return await _call_with_retry(
+            self._limiter,
+            _estimate_tokens(kwargs["messages"]),
+            lambda: self._client.messages.create(**kwargs),
+            _classify_anthropic_error,
+        )
+
+
+def _classify_anthropic_error(e: Exception):
+    # 529: overloaded
+    if isinstance(e, anthropic.APIStatusError) and e.status_code in (429, 503, 529):
+        return e.status_code, _retry_after_header(e.response)
+    return None
+
+
+class StubAPIError(Exception):
+    def __init__(self, code: int):
+        self.code = code
+        super().__init__(f"stub error {code}")
+
+
+class EchoClient:
+    """
+    Deterministic offline backend for benchmarks and stress tests.
+
+    Echoes the prompt (up to `echo_until`, if given) after a random latency,
+    and fails with a retryable 429/503 at `error_rate`. It doesn't use the
+    cache, so every run exercises the whole pipeline.
+    """
+
+    default_model = "echo"
+    fallback_model = "echo-fallback"
+
+    def __init__(
+        self,
+        latency: tuple[float, float] = (0.0, 0.0),
+        error_rate: float = 0.0,
+        seed: int = 0,
+        echo_until: str | None = None,
+        limiter: AdaptiveLimiter | None = None,
+    ):
+        self._latency = latency
+        self._error_rate = error_rate
+        self._random = random.Random(seed)
+        self._echo_until = echo_until
+        self._limiter = limiter or default_limiter()
+
+    @classmethod
+    def from_env(cls, **kwargs) -> "EchoClient":
+        latency = [float(s) for s in os.environ.get("JAKO_ECHO_LATENCY", "0.5,2").split(",")]
+        return cls(
+            latency=(latency[0], latency[-1]),
+            error_rate=float(os.environ.get("JAKO_ECHO_ERROR_RATE", "0")),
+            seed=int(os.environ.get("JAKO_ECHO_SEED", "0")),
+            **kwargs,
+        )
+
+    async def agenerate(self, *, model, prompt, system_instruction, max_output_tokens, temperature, cache) -> Completion:
+        async def call():
+            await asyncio.sleep(self._random.uniform(*self._latency))
+            if self._random.random() < self._error_rate:
+                raise StubAPIError(self._random.choice((429, 503)))
+            return prompt.split(self._echo_until)[0] if self._echo_until else prompt
+
+        text = await _call_with_retry(self._limiter, _estimate_tokens(prompt), call, _classify_stub_error)
+        return Completion(text=text, finish_reason="STOP", complete=True)
+
+
+def _classify_stub_error(e: Exception):
+    if isinstance(e, StubAPIError):
+        return e.code, None
+    return None
+
+
+BACKENDS: dict[str, Callable[..., LLMClient]] = {
+    "gemini": GoogleGenaiClient,
+    "openai": OpenAIClient,
+    "anthropic": AnthropicClient,
+    "echo": EchoClient.from_env,
+}
+
+
+def create_backend(name: str, **kwargs) -> LLMClient:
+    try:
+        factory = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"unknown LLM backend: {name}")
+    return factory(**kwargs)
@@ -58,3 +58,22 @@ class PageData(BaseModel):
     links_langlinks: list[PageLanglinks]
     last_rev_timestamp: datetime
     metadata: dict = {}
+
+
+class PageMetadata(BaseModel):
+    """The parts of PageData that publishing needs, without the page HTML."""
+    title: str
+    pageid: int
+    revid: int
+    redirects: list[Redirect] = []
+    last_rev_timestamp: datetime
+
+    @classmethod
+    def from_page_data(cls, data: PageData) -> "PageMetadata":
+        return cls(
+            title=data.page.title,
+            pageid=data.page.pageid,
+            revid=data.page.revid,
+            redirects=data.page.redirects,
+            last_rev_timestamp=data.last_rev_timestamp,
+        )
@@ -1,7 +1,11 @@
+import json
 import re
-from typing import Any, Iterable
+import struct
+from typing import Any, Callable, Iterable, Iterator, NamedTuple
 import bs4
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, field_serializer, field_validator
+
+from jako.attr_table import AttrTable, AttrTableBuilder
 
 
 class CiteRefRestoreInfo(BaseModel):
@@ -10,12 +14,43 @@ class CiteRefRestoreInfo(BaseModel):
     post: str
 
 
+RESTORE_INFO_MAGIC = b"JKRI\x01"
+
+
 class RestoreInfo(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     metadata_tags: list[str]
-    attrs: dict[int, dict[str, str | Any]]
+    # {node_id: {**attrs, "_tag": tag name}}
+    attrs: AttrTable
     cite_refs: dict[str, CiteRefRestoreInfo]
     references: dict[str, str] = {}
 
+    @field_validator("attrs", mode="before")
+    @classmethod
+    def _validate_attrs(cls, value):
+        if isinstance(value, AttrTable):
+            return value
+        return AttrTable.from_dict({int(node_id): attrs for node_id, attrs in value.items()})
+
+    @field_serializer("attrs")
+    def _serialize_attrs(self, attrs: AttrTable):
+        return attrs.to_dict()
+
+    def to_bytes(self) -> bytes:
+        header = self.model_dump_json(exclude={"attrs"}).encode()
+        return RESTORE_INFO_MAGIC + struct.pack("<I", len(header)) + header + self.attrs.to_bytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "RestoreInfo":
+        if not data.startswith(RESTORE_INFO_MAGIC):
+            raise ValueError("not a restore info")
+        pos = len(RESTORE_INFO_MAGIC)
+        (header_size,) = struct.unpack_from("<I", data, pos)
+        pos += 4
+        header = json.loads(data[pos:pos + header_size])
+        return cls(**header, attrs=AttrTable.from_bytes(memoryview(data)[pos + header_size:]))
+
 
 HTML_FORMATTER = bs4.formatter.HTMLFormatter(
     entity_substitution=bs4.formatter.EntitySubstitution.substitute_xml,
@@ -36,7 +71,11 @@ def to_html(doc: bs4.BeautifulSoup | bs4.Tag | bs4.NavigableString) -> str:
 
 def preprocess_html(html: str, title: str, keep_cite_ref_a: bool = False):
     doc = parse_html(html)
+    restore_info = _preprocess_doc(doc, title, keep_cite_ref_a)
+    return to_html(doc).strip(), restore_info
+
 
+def _preprocess_doc(doc: bs4.BeautifulSoup, title: str, keep_cite_ref_a: bool, start_node_id: int = 0) -> RestoreInfo:
     if title:
         title_tag = doc.new_tag('title')
         title_tag.string = title
@@ -112,8 +151,8 @@ def preprocess_html(html: str, title: str, keep_cite_ref_a: bool = False):
         ref.clear()
         ref.extend(ref_text_contents)
 
-    attrs = {}
-    next_node_id = 0
+    attrs = AttrTableBuilder()
+    next_node_id = start_node_id
     for node in doc.descendants:
         if not isinstance(node, bs4.Tag):
             continue
@@ -127,14 +166,13 @@ def preprocess_html(html: str, title: str, keep_cite_ref_a: bool = False):
 
         node_id = next_node_id
         next_node_id += 1
-        attrs[node_id] = node.attrs.copy()
-        attrs[node_id]["_tag"] = node.name
+        attrs.add(node_id, {**node.attrs, "_tag": node.name})
         node.attrs.clear()
         node.attrs["id"] = f"{node_id:x}"  # using hex seems to be more robust
     
-    return to_html(doc).strip(), RestoreInfo(
+    return RestoreInfo(
         metadata_tags=metadata_tags,
-        attrs=attrs,
+        attrs=attrs.build(),
         cite_refs=cite_refs,
         references=references,
     )
@@ -244,6 +282,66 @@ def split_html_chunks(html: str, chunk_size: int) -> Iterable[str]:
         yield chunk
 
 
+def validate_chunk(original: str, translated: str):
+    # checks the same things restore_html does, but per chunk,
+    # so that only the broken chunk needs to be translated again
+    expected_tags = {node.attrs["id"]: node.name for node in parse_html(original).find_all(id=True)}
+    for node in parse_html(translated).find_all(id=True):
+        node_id = node.attrs["id"]
+        expected_tag = expected_tags.get(node_id)
+        if expected_tag is None:
+            raise BrokenHtmlError(node, f"unexpected id: {node_id}")
+        if node.name != expected_tag:
+            if node.name == "td":
+                first_child = next(node.children, None)
+                if first_child is not None and first_child.name == expected_tag and first_child.attrs.get("id") == node_id:
+                    continue
+            raise TagMismatchError(node, expected_tag=expected_tag)
+
+
+# only a real id attribute, not e.g. data-id
+NODE_ID_PATTERN = re.compile(r'(<[a-zA-Z][^<>]*?\sid=["\']?)([^\s"\'<>]+)')
+
+
+def localize_node_ids(chunk: str) -> tuple[str, list[str]]:
+    # node ids are numbered across the page; renumbering them from 0 makes the
+    # same content (e.g. a navbox) the same chunk on every page, so that it can
+    # be shared through the cache. Returns the chunk and its original ids.
+    node_ids: list[str] = []
+    local_ids: dict[str, str] = {}
+
+    def replace(m: re.Match) -> str:
+        node_id = m.group(2)
+        local_id = local_ids.get(node_id)
+        if local_id is None:
+            local_id = local_ids[node_id] = f"{len(node_ids):x}"
+            node_ids.append(node_id)
+        return m.group(1) + local_id
+
+    return NODE_ID_PATTERN.sub(replace, chunk), node_ids
+
+
+def globalize_node_ids(html: str, node_ids: list[str]) -> str:
+    # the inverse of localize_node_ids; raises BrokenHtmlError for an id that
+    # is not in the chunk, so that the chunk is translated again
+    global_ids = {f"{i:x}": node_id for i, node_id in enumerate(node_ids)}
+
+    def replace(m: re.Match) -> str:
+        node_id = global_ids.get(m.group(2))
+        if node_id is None:
+            raise BrokenHtmlError(_tag_at(html, m.start()), f"unexpected id: {m.group(2)}")
+        return m.group(1) + node_id
+
+    return NODE_ID_PATTERN.sub(replace, html)
+
+
+def _tag_at(html: str, pos: int) -> bs4.Tag:
+    line = html.count("\n", 0, pos) + 1
+    col = pos - (html.rfind("\n", 0, pos) + 1)
+    tags = parse_html(html).find_all(True)
+    return next((tag for tag in tags if (tag.sourceline, tag.sourcepos) == (line, col)), tags[0])
+
+
 def validate_html(html: str, restore_info: RestoreInfo) -> bool:
     doc = parse_html(html)
     
@@ -280,6 +378,17 @@ def strip_broken_tag(html: str):
 def split_mediawiki_html_sections(html: str) -> list[str]:
     doc = parse_html(html)
 
+    roots = list(iterate_effective_children(doc))
+    assert len(roots) == 1
+    root = roots[0]
+    assert root.name == "div" and "mw-parser-output" in root.attrs["class"]
+
+    groups = _mediawiki_section_groups(root)
+    assert groups is not None
+    return [''.join(to_html(node) for node in group) for group in groups]
+
+
+def _mediawiki_section_groups(root: bs4.Tag) -> list[list[bs4.Tag]] | None:
     # MediaWiki HTML has the following format:
     #
     # <div class="mw-content-ltr mw-parser-output" lang="ja" dir="ltr">
@@ -293,37 +402,32 @@ def split_mediawiki_html_sections(html: str) -> list[str]:
     #
     #   ...
     # </div>
-
+    #
+    # Returns [[section 0], [heading 1, section 1], ...], or None if it doesn't match.
+
+    children = list(iterate_effective_children(root))
+    if not children or children[0].name != "section":
+        return None
+    groups = [[children[0]]]
+    for heading, section in zip(children[1::2], children[2::2]):
+        if not (heading.name == "div" and "section-heading" in heading.attrs.get("class", [])):
+            return None
+        if section.name != "section":
+            return None
+        groups.append([heading, section])
+    if len(children) % 2 == 0:
+        return None
+    return groups
+
+
+def _find_mediawiki_root(doc: bs4.BeautifulSoup) -> bs4.Tag | None:
     roots = list(iterate_effective_children(doc))
-    assert len(roots) == 1
+    if len(roots) != 1:
+        return None
     root = roots[0]
-    assert root.name == "div" and "mw-parser-output" in root.attrs["class"]
-
-    iterator = iterate_effective_children(root)
-
-    def read_section():
-        section = next(iterator, None)
-        if section is None: return None
-        assert section.name == "section"
-        return section
-
-    def read_heading():
-        heading = next(iterator, None)
-        if heading is None: return None
-        assert heading.name == "div" and "section-heading" in heading.attrs["class"]
-        return heading
-    
-    sections = []
-    sections.append(to_html(read_section()))
-
-    while True:
-        heading = read_heading()
-        if heading is None: break
-        section = read_section()
-        assert section
-        sections.append(to_html(heading) + to_html(section))
-    
-    return sections
+    if not (isinstance(root, bs4.Tag) and root.name == "div" and "mw-parser-output" in root.attrs.get("class", [])):
+        return None
+    return root
 
 
 def iterate_effective_children(doc: bs4.BeautifulSoup):
@@ -341,9 +445,49 @@ def filter_effective_children(children: Iterable[bs4.PageElement]):
         yield child
 
 
-def preprocess_split_html(html: str, title: str, size: int, keep_cite_ref_a: bool = False) -> tuple[list[str], RestoreInfo]:
-    html, restore_info = preprocess_html(html, title=title, keep_cite_ref_a=keep_cite_ref_a)
-    doc = parse_html(html)
+def _normalize_like_reparsed(doc: bs4.BeautifulSoup):
+    # extracted nodes leave adjacent strings behind, which a parser would merge
+    doc.smooth()
+    # preprocess_html strips its output
+    children = list(doc.children)
+    if children and type(children[0]) is bs4.NavigableString:
+        _replace_string(children[0], children[0].lstrip())
+    children = list(doc.children)
+    if children and type(children[-1]) is bs4.NavigableString:
+        _replace_string(children[-1], children[-1].rstrip())
+
+
+def _replace_string(node: bs4.NavigableString, value: str):
+    if value:
+        node.replace_with(bs4.NavigableString(value))
+    else:
+        node.extract()
+
+
+def preprocess_split_html(
+    html: str,
+    title: str,
+    size: int,
+    keep_cite_ref_a: bool = False,
+    length: Callable[[str], int] = len,
+    start_node_id: int = 0,
+) -> tuple[list[str], RestoreInfo]:
+    # `size` is measured by `length`, e.g. a token counter instead of characters
+    return _preprocess_split_doc(parse_html(html), title, size, keep_cite_ref_a, length, start_node_id)
+
+
+def _preprocess_split_doc(
+    doc: bs4.BeautifulSoup,
+    title: str,
+    size: int,
+    keep_cite_ref_a: bool,
+    length: Callable[[str], int],
+    start_node_id: int,
+) -> tuple[list[str], RestoreInfo]:
+    restore_info = _preprocess_doc(doc, title, keep_cite_ref_a, start_node_id)
+    # split the preprocessed tree directly instead of serializing and parsing
+    # it again; make it look like it was parsed from preprocess_html's output
+    _normalize_like_reparsed(doc)
     can_split_div_classes = {"section-heading", "toc", "reflist", "thumb", "thumbinner", "mw-parser-output", "NavFrame", "NavContent", "mw-collapsible", "mw-collapsible-content",
                              "columns"}
 
@@ -389,18 +533,86 @@ def preprocess_split_html(html: str, title: str, size: int, keep_cite_ref_a: boo
 
     chunks = []
     buf = ""
+    buf_len = 0
     for part in _split_html(list(doc.children)):
-        part_len = len(part)
-        if buf and len(buf) + part_len > size:
+        part_len = length(part)
+        if buf and buf_len + part_len > size:
             chunks.append(buf)
             buf = ""
+            buf_len = 0
         buf += part
+        buf_len += part_len
     if buf:
         chunks.append(buf)
     
     return chunks, restore_info
 
 
+class PreprocessedSection(NamedTuple):
+    source: str
+    chunks: list[str]
+    # None if `source` is not translated, e.g. the wrapper's start/end tags
+    restore_info: RestoreInfo | None
+
+
+def iter_preprocess_split_html(
+    html: str,
+    title: str,
+    size: int,
+    keep_cite_ref_a: bool = False,
+    length: Callable[[str], int] = len,
+) -> Iterator[PreprocessedSection]:
+    """
+    Like `preprocess_split_html`, but preprocesses and yields one MediaWiki
+    section at a time. Each section is restored on its own with its
+    `restore_info`; node ids are unique across sections.
+
+    Metadata tags are yielded last as untranslated source, at the end of the
+    page where `restore_html` would put them.
+
+    HTML that doesn't have the MediaWiki section layout is yielded as a whole.
+    """
+    doc = parse_html(html)
+    root = _find_mediawiki_root(doc)
+    groups = _mediawiki_section_groups(root) if root is not None else None
+    if groups is None:
+        chunks, restore_info = _preprocess_split_doc(doc, title, size, keep_cite_ref_a, length, 0)
+        yield PreprocessedSection(html, chunks, restore_info)
+        return
+
+    metadata_tags = []
+    for node in doc.find_all(["link", "meta", "style"]):
+        metadata_tags.append(to_html(node))
+        node.extract()
+
+    start_tag, end_tag = to_html(doc.new_tag(root.name, attrs=root.attrs)).split("</")
+    yield PreprocessedSection(start_tag, [], None)
+
+    next_node_id = 0
+    for i, group in enumerate(groups):
+        source = ''.join(to_html(node) for node in group)
+        # preprocess the parsed section as it is, and free it as we go
+        section_doc = bs4.BeautifulSoup("", "html.parser")
+        for node in group:
+            section_doc.append(node.extract())
+        chunks, restore_info = _preprocess_split_doc(
+            section_doc,
+            title if i == 0 else "",
+            size,
+            keep_cite_ref_a,
+            length,
+            next_node_id,
+        )
+        section_doc.decompose()
+        if restore_info.attrs:
+            next_node_id = max(restore_info.attrs) + 1
+        yield PreprocessedSection(source, chunks, restore_info)
+
+    yield PreprocessedSection(f"</{end_tag}", [], None)
+    if metadata_tags:
+        yield PreprocessedSection(''.join(metadata_tags), [], None)
+
+
 START_TAGS_PATTERN = re.compile(r'^(\s*<[a-z]+>)+')
 END_TAGS_PATTERN = re.compile(r'(</[a-z]+>\s*)+$')
 
@@ -0,0 +1,79 @@
+from contextlib import contextmanager
+import json
+from pathlib import Path
+import struct
+from typing import Callable, Iterator
+
+from jako.files import atomic_writer
+from jako.preprocess_html import PreprocessedSection, RestoreInfo
+
+# bump when a change to preprocessing changes its output
+PREPROCESSOR_VERSION = 2
+
+MAGIC = b"JKPP\x02"
+
+
+def artifact_path_for(input_path: Path) -> Path:
+    return Path("data/preprocessed") / f"{input_path.stem}.bin"
+
+
+@contextmanager
+def artifact_writer(path: Path, key: dict) -> Iterator[Callable[[PreprocessedSection], None]]:
+    """
+    Yields a function that appends a preprocessed section to the artifact, so
+    that sections can be written as they are produced.
+
+    The artifact is a JSON header with the key, followed by a JSON record
+    (source and chunks) and the binary restore info for each section. It
+    replaces the previous one only if the block exits without an error.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_writer(path) as f:
+        f.write(MAGIC)
+        _write_record(f, json.dumps({"key": key}).encode())
+
+        def write_section(section: PreprocessedSection):
+            blob = section.restore_info.to_bytes() if section.restore_info else b""
+            _write_record(f, json.dumps({
+                "source": section.source,
+                "chunks": section.chunks,
+                "restore_info_size": len(blob) if section.restore_info else None,
+            }, ensure_ascii=False).encode())
+            f.write(blob)
+
+        yield write_section
+
+
+def _write_record(f, record: bytes):
+    f.write(struct.pack("<I", len(record)) + record)
+
+
+def read_artifact(path: Path, key: dict) -> list[PreprocessedSection] | None:
+    # None if there is no artifact for this key, e.g. the page or the preprocessor changed
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    if not data.startswith(MAGIC):
+        return None
+    pos = len(MAGIC)
+    header, pos = _read_record(data, pos)
+    if header["key"] != key:
+        return None
+
+    sections = []
+    while pos < len(data):
+        section, pos = _read_record(data, pos)
+        restore_info = None
+        size = section["restore_info_size"]
+        if size is not None:
+            restore_info = RestoreInfo.from_bytes(data[pos:pos + size])
+            pos += size
+        sections.append(PreprocessedSection(section["source"], section["chunks"], restore_info))
+    return sections
+
+
+def _read_record(data: bytes, pos: int) -> tuple[dict, int]:
+    (size,) = struct.unpack_from("<I", data, pos)
+    pos += 4
+    return json.loads(data[pos:pos + size]), pos + size
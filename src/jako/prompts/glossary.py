@@ -1,3 +1,7 @@
+from collections import deque
+from typing import Iterable
+
+from jako.glossary_store import GlossaryStore
 from jako.models.page import PageData
 
 
@@ -7,43 +11,103 @@ GLOSSARY_BLOCKLIST = {
 }
 
 
-def glossary(html: str, data: PageData) -> str:
-    glossary: list[tuple[str, str]] = []
-    for langlink in data.page.langlinks:
-        if langlink.lang == "ko":
-            glossary.append((data.page.title, langlink.title))
-    for link in data.links_langlinks:
-        if link.langlinks:
-            for langlink in link.langlinks:
-                if langlink.lang == "ko":
-                    glossary.append((link.title, langlink.title))
-    
-    if not glossary:
-        return ""
+class Glossary:
+    """
+    ja -> ko terms of a page, compiled into an Aho-Corasick automaton so that
+    the terms used in a chunk are found in a single pass over it.
+    """
+
+    def __init__(self, entries: Iterable[tuple[str, str]]):
+        self.entries = [(ja, ko) for ja, ko in entries if _is_glossary_term(ja, ko)]
+        self._terms = list(dict.fromkeys(ja for ja, _ko in self.entries))
+
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail = [0]
+        self._out: list[list[int]] = [[]]
+        for term_id, term in enumerate(self._terms):
+            state = 0
+            for c in term:
+                next_state = self._goto[state].get(c)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][c] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = next_state
+            self._out[state].append(term_id)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and c not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(c, 0)
+                self._out[next_state] += self._out[self._fail[next_state]]
 
-    system_prompt = ""
-    for ja, ko in glossary:
-        if ja == ko: continue
+    def find(self, html: str) -> set[str]:
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        state = 0
+        for c in html:
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if out[state]:
+                found.update(out[state])
+        return {self._terms[term_id] for term_id in found}
 
-        if ja in GLOSSARY_BLOCKLIST:
-            continue
+    def prompt(self, html: str) -> str:
+        if not self.entries:
+            return ""
+        found = self.find(html)
+        # sorted, so that the same chunk gets the same prompt on every page
+        system_prompt = "".join(f"\n{ja} -> {ko}" for ja, ko in sorted({(ja, ko) for ja, ko in self.entries if ja in found}))
+        if not system_prompt:
+            return ""
+        return f"Glossary:{system_prompt}"
 
-        # skip latin only
-        if all(ord(c) <= 128 for c in ja):
-            continue
 
-        # skip dates
-        digit_count = sum(1 for c in ja if c.isdigit())
-        if digit_count / len(ja) > 0.5:
-            continue
+def _is_glossary_term(ja: str, ko: str) -> bool:
+    if ja == ko:
+        return False
 
-        # skip if not in content
-        if ja not in html:
-            continue
+    if ja in GLOSSARY_BLOCKLIST:
+        return False
 
-        system_prompt += f"\n{ja} -> {ko}"
+    # skip latin only
+    if all(ord(c) <= 128 for c in ja):
+        return False
 
-    if not system_prompt:
-        return ""
+    # skip dates
+    digit_count = sum(1 for c in ja if c.isdigit())
+    if digit_count / len(ja) > 0.5:
+        return False
 
-    return f"Glossary:{system_prompt}"
+    return True
+
+
+def build_glossary(data: PageData, store: GlossaryStore | None = None) -> Glossary:
+    # ko titles in the store are fresher than the ones saved with the page
+    stored = store.get_ko_titles(link.title for link in data.links_langlinks) if store else {}
+    entries: list[tuple[str, str]] = []
+    for langlink in data.page.langlinks:
+        if langlink.lang == "ko":
+            entries.append((data.page.title, langlink.title))
+    for link in data.links_langlinks:
+        if link.title in stored:
+            if stored[link.title] is not None:
+                entries.append((link.title, stored[link.title]))
+        elif link.langlinks:
+            for langlink in link.langlinks:
+                if langlink.lang == "ko":
+                    entries.append((link.title, langlink.title))
+    return Glossary(entries)
+
+
+def glossary(html: str, data: PageData) -> str:
+    # prefer building the glossary once with build_glossary() for many chunks
+    return build_glossary(data).prompt(html)
@@ -3,14 +3,17 @@ import json
 import os
 from pathlib import Path
 
-import subprocess
+from typing import Iterable
 import urllib.parse
 
 import boto3
-import requests
 
-from jako.models.page import PageData
+from jako.files import atomic_write_text
+from jako.indexnow import indexnow_batch, open_indexnow_queue
 from jako.preprocess_html import fix_cite_ref_a
+from jako.source_meta import load_page_metadata
+from jako.title_index import TitleIndex, open_title_index
+from jako.upload import open_upload_manifest, upload_changed
 from multiprocessing import Pool
 import hashlib
 
@@ -41,8 +44,11 @@ def safe_filename(title: str) -> str:
     return title.replace("/", "__") + ".json"
 
 
+SITE_URL = "https://jako.sapzil.org"
+
+
 def page_url(title: str) -> str:
-    return f"https://jako.sapzil.org/wiki/{urllib.parse.quote(title)}"
+    return f"{SITE_URL}/wiki/{urllib.parse.quote(title)}"
 
 
 def is_outdated(f: Path, source_mtime: float | None) -> bool:
@@ -53,78 +59,96 @@ def is_outdated(f: Path, source_mtime: float | None) -> bool:
 
 
 def publish_page(fname: str) -> PublishInfo:
+    # files are only rewritten if their content changed, so that unchanged
+    # ones are not uploaded again
     result_file = result_dir / fname
-    mtime = result_file.stat().st_mtime
 
-    result = json.loads(result_file.read_text())
-    source = PageData.model_validate_json((source_dir / fname).read_text())
+    result_bytes = result_file.read_bytes()
+    result = json.loads(result_bytes)
+    source = load_page_metadata(source_dir / fname)
     translated_title = result["title"]
-    original_title = source.page.title
+    original_title = source.title
+    last_rev_timestamp = source.last_rev_timestamp.isoformat()
 
     translated_redirect_title = None
     redirect_titles = []
     updated = False
 
     publish_path = publish_dir / safe_filename(translated_title)
-    if is_outdated(publish_path, mtime):
+    # rendering parses the whole page, so skip it if nothing it uses changed
+    result_hash = hashlib.sha1(result_bytes + f"\0{original_title}\0{last_rev_timestamp}".encode()).hexdigest()
+    if publish_path.exists() and _published_result_hash(fname) == result_hash:
+        print(f"Up-to-date: {publish_path}")
+    else:
         result["original_title"] = original_title
-        result["last_rev_timestamp"] = source.last_rev_timestamp.isoformat()
+        result["last_rev_timestamp"] = last_rev_timestamp
         result["html"] = fix_cite_ref_a(result["html"])
-        publish_path.write_text(json.dumps(result, ensure_ascii=False, indent=2))
-        updated = True
-        print(f"Published: {publish_path}")
-    else:
-        print(f"Up-to-date: {publish_path}")
+        if _write_if_changed(publish_path, json.dumps(result, ensure_ascii=False, indent=2)):
+            updated = True
+            print(f"Published: {publish_path}")
+        else:
+            print(f"Up-to-date: {publish_path}")
 
     if translated_title != original_title:
         redirect_publish_path = publish_dir / safe_filename(original_title)
-        if is_outdated(redirect_publish_path, mtime):
-            redirect_publish_path.write_text(json.dumps({
-                "redirect": {
-                    "to": translated_title
-                }
-            }, ensure_ascii=False, indent=2))
+        if _write_if_changed(redirect_publish_path, json.dumps({
+            "redirect": {
+                "to": translated_title
+            }
+        }, ensure_ascii=False, indent=2)):
             updated = True
             print(f"Published: {redirect_publish_path} (redirect)")
         else:
             print(f"Up-to-date: {redirect_publish_path} (redirect)")
         translated_redirect_title = original_title
 
-    for redirect in source.page.redirects:
+    for redirect in source.redirects:
         redirect_publish_path = publish_dir / safe_filename(redirect.from_)
-        if is_outdated(redirect_publish_path, mtime):
-            redirect_publish_path.write_text(json.dumps({
-                "redirect": {
-                    "to": translated_title if redirect.to == original_title else redirect.to,
-                    "tofragment": redirect.tofragment
-                }
-            }, ensure_ascii=False, indent=2))
+        if _write_if_changed(redirect_publish_path, json.dumps({
+            "redirect": {
+                "to": translated_title if redirect.to == original_title else redirect.to,
+                "tofragment": redirect.tofragment
+            }
+        }, ensure_ascii=False, indent=2)):
             updated = True
             print(f"Published: {redirect_publish_path} (redirect)")
         else:
             print(f"Up-to-date: {redirect_publish_path} (redirect)")
         redirect_titles.append(redirect.from_)
     
-    if updated:
-        (publish_dir / ".stamp").touch()
-
-    return PublishInfo(
+    info = PublishInfo(
         translated_title=translated_title,
         translated_redirect_title=translated_redirect_title,
         redirect_titles=redirect_titles,
     )
+    index = open_title_index()
+    index.update(fname, info.all_titles)
+    index.set_result_hash(fname, result_hash)
+    index.close()
+    if updated:
+        (publish_dir / ".stamp").touch()
+
+    return info
+
+
+def _published_result_hash(fname: str) -> str | None:
+    index = open_title_index()
+    try:
+        return index.get_result_hash(fname)
+    finally:
+        index.close()
 
 
 def check_publish_status(fname: str) -> PublishInfo | None:
     result_file = result_dir / fname
 
     result = json.loads(result_file.read_text())
-    source = PageData.model_validate_json((source_dir / fname).read_text())
-    original_title = source.page.title
+    source = load_page_metadata(source_dir / fname)
+    original_title = source.title
 
     translated_title = result["title"]
     translated_redirect_title = original_title if translated_title != original_title else None
-    redirect_titles = [redirect.from_ for redirect in source.page.redirects]
+    redirect_titles = [redirect.from_ for redirect in source.redirects]
 
     return PublishInfo(
         translated_title=translated_title,
@@ -133,18 +157,6 @@ def check_publish_status(fname: str) -> PublishInfo | None:
     )
 
 
-def indexnow_batch(urls: list[str]):
-    resp = requests.post("https://api.indexnow.org/indexnow", json={
-        "host": "jako.sapzil.org",
-        "key": "198c6938537a4c3185af9ff04fa38082",
-        "keyLocation": "https://jako.sapzil.org/indexnowkey",
-        "urlList": urls,
-    })
-    if not resp.ok:
-        print(resp.content)
-        resp.raise_for_status()
-
-
 def publish_sitemap():
     mtime = None
     if (publish_dir / ".stamp").exists():
@@ -155,38 +167,86 @@ def publish_sitemap():
         print("Sitemap not updated (mtime)")
         return
 
-    titles = []
-    for fname in os.listdir(result_dir):
+    index = open_title_index()
+    if not index.backfilled:
+        rebuild_title_index(index)
+    changed = write_sitemaps(index)
+    index.close()
+    if not changed:
+        print("Sitemap not updated (checksum)")
+        # keep it newer than the stamp
+        sitemap_path.touch()
+    for path in changed:
+        print(f"Sitemap updated: {path}")
+    upload_published(changed)
+
+
+def publish_key(path: Path) -> str:
+    return path.relative_to(publish_dir).as_posix()
+
+
+def upload_published(paths: Iterable[Path], client=None) -> list[str]:
+    """
+    Uploads the given files in the publish directory whose content differs
+    from what was last uploaded.
+    """
+    manifest = open_upload_manifest()
+    try:
+        client = client or s3
+        if not len(manifest):
+            manifest.seed_from_bucket(client)
+        return upload_changed([(path, publish_key(path)) for path in paths], client, manifest)
+    finally:
+        manifest.close()
+
+
+def rebuild_title_index(index: TitleIndex):
+    for fname in sorted(os.listdir(result_dir)):
         if not fname.endswith(".json"):
             continue
         info = check_publish_status(fname)
         if info:
-            titles.extend(info.all_titles)
-
-    prev_checksum = None
-    if sitemap_path.exists():
-        with sitemap_path.open("rb") as f:
-            prev_checksum = hashlib.file_digest(f, "sha1").hexdigest()
-
-    write_sitemap(sitemap_path, titles)
-    with sitemap_path.open("rb") as f:
-        new_checksum = hashlib.file_digest(f, "sha1").hexdigest()
-    
-    print(f"Sitemap checksum: {prev_checksum=} {new_checksum=}")
-    if prev_checksum != new_checksum:
-        print("Sitemap updated")
-        s3.upload_file(str(sitemap_path), "jako-data-kr", sitemap_path.name)
-    else:
-        print("Sitemap not updated (checksum)")
-
-
-def write_sitemap(path: Path, titles: list[str]):
-    with open(path, "w") as f:
-        f.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n")
-        f.write("<urlset xmlns=\"http://www.sitemaps.org/schemas/sitemap/0.9\">\n")
-        for title in titles:
-            f.write(f"<url><loc>{page_url(title)}</loc></url>\n")
-        f.write("</urlset>\n")
+            index.update(fname, info.all_titles)
+    index.mark_backfilled()
+
+
+def write_sitemaps(index: TitleIndex) -> list[Path]:
+    """
+    Writes a sitemap per index shard and a sitemap index (sitemap.xml) that
+    lists them. Returns the files whose content changed, shards first.
+    """
+    changed = []
+    shard_names = []
+    for shard, titles in index.shards().items():
+        name = f"sitemaps/sitemap-{shard}.xml"
+        shard_names.append(name)
+        if _write_if_changed(publish_dir / name, sitemap_xml(titles)):
+            changed.append(publish_dir / name)
+
+    sitemap_index = "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
+    sitemap_index += "<sitemapindex xmlns=\"http://www.sitemaps.org/schemas/sitemap/0.9\">\n"
+    for name in shard_names:
+        sitemap_index += f"<sitemap><loc>{SITE_URL}/{name}</loc></sitemap>\n"
+    sitemap_index += "</sitemapindex>\n"
+    if _write_if_changed(publish_dir / "sitemap.xml", sitemap_index):
+        changed.append(publish_dir / "sitemap.xml")
+    return changed
+
+
+def _write_if_changed(path: Path, content: str) -> bool:
+    if path.exists() and hashlib.sha1(path.read_bytes()).digest() == hashlib.sha1(content.encode()).digest():
+        return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write_text(path, content)
+    return True
+
+
+def sitemap_xml(titles: list[str]) -> str:
+    content = "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
+    content += "<urlset xmlns=\"http://www.sitemaps.org/schemas/sitemap/0.9\">\n"
+    content += "".join(f"<url><loc>{page_url(title)}</loc></url>\n" for title in titles)
+    content += "</urlset>\n"
+    return content
 
 
 def main():
@@ -210,14 +270,19 @@ def main():
             translated_redirect_count += 1
         redirect_count += len(result.redirect_titles)
 
-    write_sitemap(publish_dir / "sitemap.xml", titles)
+    # publish_page has updated the title index with every result
+    index = open_title_index()
+    index.mark_backfilled()
+    write_sitemaps(index)
+    index.close()
     print("Published: sitemap.xml")
 
-    subprocess.run(["aws", "s3", "sync", publish_dir, "s3://jako-data-kr/"], check=True)
+    upload_published(path for path in publish_dir.rglob("*") if path.is_file() and not path.name.startswith("."))
 
     print("Calling IndexNow API...")
-    urls = [page_url(title) for title in titles]
-    indexnow_batch(urls)
+    queue = open_indexnow_queue()
+    queue.add(page_url(title) for title in titles)
+    queue.flush()
 
     print("-" * 30)
     print(f"Stats: {canonical_count=} {translated_redirect_count=} {redirect_count=}")
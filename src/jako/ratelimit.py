@@ -0,0 +1,124 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+import random
+import time
+import weakref
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, capacity: float | None = None):
+        self._rate = per_minute / 60
+        self._capacity = capacity if capacity is not None else per_minute
+        self._tokens = self._capacity
+        self._updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    async def acquire(self, amount: float = 1):
+        # a single request larger than the bucket would wait forever otherwise
+        amount = min(amount, self._capacity)
+        while True:
+            self._refill()
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return
+            await asyncio.sleep((amount - self._tokens) / self._rate)
+
+
+# tasks that got a slot, i.e. whose request may already have been sent
+_tasks_in_slot: "weakref.WeakSet[asyncio.Task]" = weakref.WeakSet()
+
+
+def holds_slot(task: asyncio.Task) -> bool:
+    return task in _tasks_in_slot
+
+
+class AdaptiveLimiter:
+    """
+    Limits in-flight requests and request/token rates.
+
+    The concurrency window grows by one slot per window of successful requests
+    (additive increase) and halves when the server throttles us (multiplicative
+    decrease), within [min_concurrency, max_concurrency].
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        requests_per_minute: float | None = None,
+        tokens_per_minute: float | None = None,
+        min_concurrency: int = 1,
+    ):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self._window = float(max_concurrency)
+        self._in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self._last_throttled_at = 0.0
+        self._requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    @property
+    def window(self) -> int:
+        return max(self.min_concurrency, int(self._window))
+
+    @asynccontextmanager
+    async def slot(self, tokens: int = 0):
+        await self._acquire()
+        task = asyncio.current_task()
+        try:
+            if self._requests:
+                await self._requests.acquire()
+            if self._tokens and tokens:
+                await self._tokens.acquire(tokens)
+            _tasks_in_slot.add(task)
+            yield
+        finally:
+            _tasks_in_slot.discard(task)
+            self._release()
+
+    async def _acquire(self):
+        while self._in_flight >= self.window:
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+            try:
+                await future
+            finally:
+                if future in self._waiters:
+                    self._waiters.remove(future)
+        self._in_flight += 1
+
+    def _release(self):
+        self._in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        for _ in range(self.window - self._in_flight):
+            if not self._waiters:
+                break
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+
+    def on_success(self):
+        self._window = min(self.max_concurrency, self._window + 1 / self._window)
+        self._wake()
+
+    def on_throttled(self):
+        now = time.monotonic()
+        # requests that were already in flight get throttled together;
+        # count them as a single congestion signal
+        if now - self._last_throttled_at < 1:
+            return
+        self._last_throttled_at = now
+        self._window = max(self.min_concurrency, self._window / 2)
+        print(f"Throttled, concurrency window = {self.window}")
+
+
+def backoff_delay(attempt: int, base: float = 2, cap: float = 120) -> float:
+    # exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
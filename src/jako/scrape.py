@@ -1,31 +1,127 @@
 import argparse
-from collections import defaultdict
+import asyncio
+from contextlib import closing
 from datetime import datetime
-from typing import Iterable
+from typing import AsyncIterator, Iterable, Iterator
 from pathlib import Path
-from itertools import batched
+import os
+import threading
+import time
+import urllib.parse
 
+from pydantic import BaseModel
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm.auto import tqdm
 
+from jako.files import atomic_write_text
+from jako.glossary_store import GlossaryStore, open_glossary_store
 from jako.models.page import Page, PageLanglinks, PageData
+from jako.ratelimit import backoff_delay
+from jako.source_meta import write_page_metadata
 
 API_URL = "https://ja.wikipedia.org/w/api.php"
-SESSION = requests.Session()
-SESSION.headers["user-agent"] = f"Jako/0.1 (github.com/dittos) {SESSION.headers['user-agent']}"
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# keep GET URLs well under the ~8KB that Wikimedia's servers accept
+MAX_TITLES_URL_BYTES = 6000
+
+
+class MediaWikiClient:
+    """
+    Pooled MediaWiki API client that can be shared by threads and event loops.
+
+    At most `max_concurrency` requests are in flight and requests are spaced
+    to stay under `requests_per_second`. Throttled, failed and lagged
+    requests are retried with backoff.
+
+    Requests are sent with `maxlag`, so that the API refuses them while its
+    replicas lag more than that many seconds.
+    """
+
+    def __init__(
+        self,
+        api_url: str = API_URL,
+        max_concurrency: int | None = None,
+        requests_per_second: float | None = None,
+        max_retries: int = 5,
+        max_titles: int | None = None,
+        maxlag: int = 5,
+    ):
+        self.api_url = api_url
+        self.maxlag = maxlag
+        # titles per query; 500 with the apihighlimits right (bots)
+        self.max_titles = max_titles or int(os.environ.get("JAKO_SCRAPE_MAX_TITLES", "50"))
+        self.max_concurrency = max_concurrency or int(os.environ.get("JAKO_SCRAPE_MAX_CONCURRENCY", "4"))
+        requests_per_second = requests_per_second or float(os.environ.get("JAKO_SCRAPE_RPS", "5"))
+        self._interval = 1 / requests_per_second
+        self._max_retries = max_retries
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._lock = threading.Lock()
+        self._next_request_at = 0.0
+        self._session = requests.Session()
+        self._session.headers["user-agent"] = f"Jako/0.1 (github.com/dittos) {self._session.headers['user-agent']}"
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def _wait_turn(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_request_at - now
+            self._next_request_at = max(now, self._next_request_at) + self._interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def call(self, params: dict) -> dict:
+        for attempt in range(self._max_retries + 1):
+            retry_after = None
+            try:
+                with self._slots:
+                    self._wait_turn()
+                    response = self._session.get(self.api_url, params={**params, "maxlag": self.maxlag}, timeout=60)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self._max_retries:
+                    raise
+                print(f"request failed: {e}")
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self._max_retries:
+                    if not response:
+                        print(f"error response: {response.text}")
+                        response.raise_for_status()
+                    data = response.json()
+                    # https://www.mediawiki.org/wiki/Manual:Maxlag_parameter
+                    if data.get("error", {}).get("code") != "maxlag" or attempt == self._max_retries:
+                        return data
+                print(f"error response: {response.status_code}")
+                retry_after = _retry_after(response)
+            delay = max(backoff_delay(attempt, base=1, cap=60), retry_after or 0)
+            print(f"retrying in {delay:.1f} seconds...")
+            time.sleep(delay)
+        raise Exception("retry failed")
+
+    async def acall(self, params: dict) -> dict:
+        return await asyncio.to_thread(self.call, params)
+
+
+def _retry_after(response: requests.Response) -> float | None:
+    try:
+        return float(response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+CLIENT = MediaWikiClient()
 
 
 def call_api(params: dict):
-    response = SESSION.get(API_URL, params=params)
-    if not response:
-        print(f"error response: {response.text}")
-        response.raise_for_status()
-    return response.json()
+    return CLIENT.call(params)
 
 
-def parse_page(page: str) -> Page:
+async def aparse_page(page: str, client: MediaWikiClient = CLIENT) -> Page:
     # https://www.mediawiki.org/wiki/API:Parsing_wikitext
-    data = call_api({
+    data = await client.acall({
         "action": "parse",
         "page": page,
         "formatversion": "2",
@@ -38,76 +134,118 @@ def parse_page(page: str) -> Page:
     return Page.model_validate(data["parse"])
 
 
-def batch_get_page_langlinks(titles: list[str], lang: str) -> list[PageLanglinks]:
-    # https://www.mediawiki.org/wiki/API:Query
-    params = {
-        "action": "query",
-        "titles": "|".join(titles),
-        "formatversion": "2",
-        "format": "json",
-        "prop": "langlinks",
-        "lllang": lang,
-    }
-    result = defaultdict(dict)
-    while True:
-        data = call_api(params)
-        for page in data["query"]["pages"]:
-            result[page["title"]].update(page)
+def parse_page(page: str) -> Page:
+    return asyncio.run(aparse_page(page))
 
-        cont = data.get("continue")
-        if cont:
-            params.update(cont)
-        else:
-            break
-    
-    models = []
-    for p in result.values():
-        model = PageLanglinks.model_validate(p)
-        models.append(model)
-    return models
 
+def pack_titles(titles: Iterable[str], max_titles: int, max_bytes: int = MAX_TITLES_URL_BYTES) -> Iterator[list[str]]:
+    batch = []
+    batch_bytes = 0
+    for title in titles:
+        # "|" is encoded as %7C
+        size = len(urllib.parse.quote(title)) + 3
+        if batch and (len(batch) == max_titles or batch_bytes + size > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(title)
+        batch_bytes += size
+    if batch:
+        yield batch
 
-def batch_get_page_infos(titles: list[str]):
-    # https://www.mediawiki.org/wiki/API:Query
-    params = {
-        "action": "query",
-        "titles": "|".join(titles),
-        "formatversion": "2",
-        "format": "json",
-        "prop": "info",
-    }
-    result = defaultdict(dict)
+
+async def aiter_query_pages(params: dict, client: MediaWikiClient = CLIENT) -> AsyncIterator[dict]:
+    """
+    Runs a query through all its continuations, and yields each page once
+    all of its data has arrived (when the response has `batchcomplete`).
+    """
+    # https://www.mediawiki.org/wiki/API:Query#Continuing_queries
+    params = dict(params)
+    pages: dict[str, dict] = {}
     while True:
-        data = call_api(params)
+        data = await client.acall(params)
         for page in data["query"]["pages"]:
-            result[page["title"]].update(page)
+            _merge_page(pages.setdefault(page["title"], {}), page)
+
+        if "batchcomplete" in data:
+            for page in pages.values():
+                yield page
+            pages.clear()
 
         cont = data.get("continue")
         if cont:
             params.update(cont)
         else:
             break
-    return dict(result)
+    for page in pages.values():
+        yield page
+
+
+def _merge_page(target: dict, page: dict):
+    # list props (e.g. langlinks) are split across continuations
+    for key, value in page.items():
+        if isinstance(value, list) and isinstance(target.get(key), list):
+            target[key].extend(value)
+        else:
+            target[key] = value
+
+
+async def aiter_page_langlinks(titles: Iterable[str], lang: str, client: MediaWikiClient = CLIENT) -> AsyncIterator[PageLanglinks]:
+    for batch in pack_titles(titles, client.max_titles):
+        async for page in aiter_query_pages({
+            "action": "query",
+            "titles": "|".join(batch),
+            "formatversion": "2",
+            "format": "json",
+            "prop": "langlinks",
+            "lllang": lang,
+        }, client):
+            yield PageLanglinks.model_validate(page)
+
+
+async def abatch_get_page_langlinks(titles: list[str], lang: str, client: MediaWikiClient = CLIENT) -> list[PageLanglinks]:
+    return [page async for page in aiter_page_langlinks(titles, lang, client)]
+
+
+def batch_get_page_langlinks(titles: list[str], lang: str) -> list[PageLanglinks]:
+    return asyncio.run(abatch_get_page_langlinks(titles, lang))
+
+
+async def aiter_page_infos(titles: Iterable[str], client: MediaWikiClient = CLIENT) -> AsyncIterator[dict]:
+    for batch in pack_titles(titles, client.max_titles):
+        async for page in aiter_query_pages({
+            "action": "query",
+            "titles": "|".join(batch),
+            "formatversion": "2",
+            "format": "json",
+            "prop": "info",
+        }, client):
+            yield page
+
+
+async def abatch_get_page_infos(titles: list[str], client: MediaWikiClient = CLIENT) -> dict[str, dict]:
+    return {page["title"]: page async for page in aiter_page_infos(titles, client)}
+
+
+def batch_get_page_infos(titles: list[str]):
+    return asyncio.run(abatch_get_page_infos(titles))
 
 
 def get_category_members(category: str):
-    if not category.startswith("Category:"):
-        category = f"Category:{category}"
-    
     params = {
         "action": "query",
         "format": "json",
         "list": "categorymembers",
-        "cmtitle": category,
-        "cmtype": "page",  # exclude subcategories (TODO: recursive)
+        "cmtitle": _category_title(category),
+        "cmtype": "page",  # exclude subcategories; see crawl_category
         "cmlimit": 100,
     }
-    
+
     while True:
         data = call_api(params)
         for member in data["query"]["categorymembers"]:
             yield member
-        
+
         cont = data.get("continue")
         if cont:
             params.update(cont)
@@ -115,51 +253,202 @@ def get_category_members(category: str):
             break
 
 
-def download_pages(titles: Iterable[str]):
-    for batch in batched(tqdm(titles), 20):
+def _category_title(category: str) -> str:
+    return category if category.startswith("Category:") else f"Category:{category}"
+
+
+CATEGORY_NS = 14
+
+
+class CategoryFrontier(BaseModel):
+    category: str
+    max_depth: int
+    # (category, depth, continue params) to be listed, in BFS order
+    queue: list[tuple[str, int, dict]]
+    visited_categories: set[str]
+    seen_titles: set[str] = set()
+
+
+def source_path_for(title: str) -> Path:
+    return Path("data/source") / f"{title.replace('/', '__')}.json"
+
+
+def crawl_state_path_for(category: str) -> Path:
+    # shared by the CLI and the worker, so that either can resume the other's crawl
+    return Path("data/crawl") / f"{category.replace('/', '__')}.json"
+
+
+def is_downloaded(title: str) -> bool:
+    filename = source_path_for(title).name
+    return (Path("data/source") / filename).exists() or (Path("data/result") / filename).exists()
+
+
+def crawl_category(category: str, max_depth: int = 3, state_path: Path | None = None, client: MediaWikiClient = CLIENT) -> Iterator[str]:
+    """
+    Yields the titles of pages in `category` and its subcategories down to
+    `max_depth`, once each, leaving out pages that are already downloaded.
+
+    With `state_path`, the frontier is saved there after every response, and
+    an interrupted crawl resumes from it. Titles yielded right before an
+    interruption may be yielded again.
+    """
+    category = _category_title(category)
+    frontier = None
+    if state_path and state_path.exists():
+        frontier = CategoryFrontier.model_validate_json(state_path.read_text())
+        if frontier.category != category or frontier.max_depth != max_depth:
+            frontier = None
+        else:
+            print(f"resuming crawl: {len(frontier.queue)} categories in frontier, {len(frontier.seen_titles)} titles seen")
+    if frontier is None:
+        frontier = CategoryFrontier(category=category, max_depth=max_depth, queue=[(category, 0, {})], visited_categories={category})
+
+    while frontier.queue:
+        current, depth, cont = frontier.queue[0]
+        data = client.call({
+            "action": "query",
+            "format": "json",
+            "list": "categorymembers",
+            "cmtitle": current,
+            "cmtype": "page|subcat" if depth < max_depth else "page",
+            "cmlimit": "max",
+            **cont,
+        })
+        titles = []
+        for member in data["query"]["categorymembers"]:
+            title = member["title"]
+            if member["ns"] == CATEGORY_NS:
+                if title not in frontier.visited_categories:
+                    frontier.visited_categories.add(title)
+                    frontier.queue.append((title, depth + 1, {}))
+            elif title not in frontier.seen_titles:
+                frontier.seen_titles.add(title)
+                if not is_downloaded(title):
+                    titles.append(title)
+
+        yield from titles
+
+        if data.get("continue"):
+            frontier.queue[0] = (current, depth, data["continue"])
+        else:
+            frontier.queue.pop(0)
+        if state_path:
+            state_path.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write_text(state_path, frontier.model_dump_json())
+
+    if state_path:
+        # done; the next crawl starts over
+        state_path.unlink(missing_ok=True)
+
+
+async def adownload_pages(titles: Iterable[str], refresh: bool = False, client: MediaWikiClient = CLIENT):
+    titles = list(titles)
+    progress = tqdm(total=len(titles))
+    # limit the pages in flight; their requests are limited by the client
+    pages_in_flight = asyncio.Semaphore(client.max_concurrency)
+    store = open_glossary_store()
+
+    async def download(title: str, info: dict):
+        async with pages_in_flight:
+            try:
+                await adownload_page(title, info, refresh=refresh, client=client, store=store)
+            finally:
+                progress.update()
+
+    async def download_batch(batch: list[str]):
         print(f"\nfetching info: batch size = {len(batch)}, first = {batch[0]}, last = {batch[-1]}")
-        infos = batch_get_page_infos(batch)
+        async with asyncio.TaskGroup() as tg:
+            # pages are downloaded as their infos arrive
+            async for info in aiter_page_infos(batch, client):
+                tg.create_task(download(info["title"], info))
+
+    try:
+        async with asyncio.TaskGroup() as tg:
+            for batch in pack_titles(titles, client.max_titles):
+                tg.create_task(download_batch(batch))
+    finally:
+        progress.close()
+        store.close()
 
-        for title in batch:
-            info = infos[title]
-            download_page(title, info)
 
+def download_pages(titles: Iterable[str], refresh: bool = False):
+    asyncio.run(adownload_pages(titles, refresh=refresh))
 
-def download_page(title: str, info: dict) -> bool:
+
+async def adownload_page(
+    title: str,
+    info: dict,
+    refresh: bool = False,
+    client: MediaWikiClient = CLIENT,
+    store: GlossaryStore | None = None,
+) -> bool:
+    # with refresh, existing pages are fetched again if they have a newer revision
     last_rev_timestamp = datetime.fromisoformat(info["touched"])
 
-    save_path = Path("data/source") / f"{title.replace('/', '__')}.json"
+    save_path = source_path_for(title)
     if save_path.exists():
         data = PageData.model_validate_json(save_path.read_text())
         age = (last_rev_timestamp - data.last_rev_timestamp).days
-        print(f"skipping page: {title} (age={age}d)")
-        return False
-    
+        if not refresh or data.page.revid == info.get("lastrevid", data.page.revid):
+            print(f"skipping page: {title} (age={age}d)")
+            return False
+        print(f"refreshing page: {title} (revid {data.page.revid} -> {info['lastrevid']})")
+
     print(f"fetching page: {title}")
-    page = parse_page(title)
-    langlinks = []
-    for links_batch in batched((link.title for link in page.links if link.exists), 20):
-        langlinks.extend(batch_get_page_langlinks(links_batch, "ko"))
-    
+    page = await aparse_page(title, client)
+    link_titles = [link.title for link in page.links if link.exists]
+    if store is None:
+        with closing(open_glossary_store()) as store:
+            langlinks = await aget_links_langlinks(link_titles, store, client)
+    else:
+        langlinks = await aget_links_langlinks(link_titles, store, client)
+
     data = PageData(
         page=page,
         links_langlinks=langlinks,
         last_rev_timestamp=last_rev_timestamp,
     )
-    save_path.write_text(data.model_dump_json(indent=2, by_alias=True))
+    save_path.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write_text(save_path, data.model_dump_json(indent=2, by_alias=True))
+    write_page_metadata(save_path, data)
     return True
 
 
+def download_page(title: str, info: dict, refresh: bool = False) -> bool:
+    return asyncio.run(adownload_page(title, info, refresh=refresh))
+
+
+async def aget_links_langlinks(titles: list[str], store: GlossaryStore, client: MediaWikiClient = CLIENT) -> list[PageLanglinks]:
+    # ko langlinks are looked up in the store first; only missing or stale ones are fetched
+    stored = store.get_many(titles)
+    missing = [title for title in titles if title not in stored]
+    batches = await asyncio.gather(*(
+        abatch_get_page_langlinks(links_batch, "ko", client)
+        for links_batch in pack_titles(missing, client.max_titles)
+    ))
+    for fetched in batches:
+        store.put_many(fetched)
+        for link in fetched:
+            stored[link.title] = link
+    print(f"langlinks: {len(titles) - len(missing)}/{len(titles)} from glossary store")
+    # in link order; titles normalized by the API come last
+    langlinks = [stored.pop(title) for title in dict.fromkeys(titles) if title in stored]
+    return langlinks + list(stored.values())
+
+
 def main(args):
-    with open(args.input) as f:
-        titles = [line.strip() for line in f if line.strip()]
-    download_pages(titles)
+    if args.input.startswith("Category:"):
+        titles = list(crawl_category(args.input, max_depth=args.max_depth, state_path=crawl_state_path_for(args.input)))
+    else:
+        with open(args.input) as f:
+            titles = [line.strip() for line in f if line.strip()]
+    download_pages(titles, refresh=args.refresh)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("input", help="Input file")
+    parser.add_argument("input", help="Input file, or Category:<name> to crawl a category")
     parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--refresh", action="store_true", help="Fetch pages again if they have a newer revision")
+    parser.add_argument("--max-depth", type=int, default=3, help="Subcategory depth when crawling a category")
     main(parser.parse_args())
-
-    # download_pages((page["title"] for page in get_category_members("Category:2024年のテレビアニメ")))
@@ -0,0 +1,29 @@
+from pathlib import Path
+
+from jako.files import atomic_write_text
+from jako.models.page import PageData, PageMetadata
+
+
+def metadata_path_for(source_path: Path) -> Path:
+    return Path("data/source_meta") / source_path.name
+
+
+def write_page_metadata(source_path: Path, data: PageData) -> PageMetadata:
+    metadata = PageMetadata.from_page_data(data)
+    path = metadata_path_for(source_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write_text(path, metadata.model_dump_json(by_alias=True))
+    return metadata
+
+
+def load_page_metadata(source_path: Path) -> PageMetadata:
+    # falls back to the full source if the sidecar is missing or older than it,
+    # and writes the sidecar for the next time
+    path = metadata_path_for(source_path)
+    try:
+        if path.stat().st_mtime >= source_path.stat().st_mtime:
+            return PageMetadata.model_validate_json(path.read_text())
+    except FileNotFoundError:
+        pass
+    data = PageData.model_validate_json(source_path.read_text())
+    return write_page_metadata(source_path, data)
@@ -0,0 +1,92 @@
+import json
+import os
+from pathlib import Path
+import sqlite3
+
+# a sitemap may list up to 50,000 URLs; pages are assigned to shards when
+# they are first indexed, with room left for redirects added later
+SHARD_TARGET_URLS = 40_000
+
+
+class TitleIndex:
+    """
+    Published titles of each result file (SQLite), so that sitemaps can be
+    generated without reading the results and sources.
+
+    Each page stays in the sitemap shard it was first assigned to, so adding
+    pages only changes the last shard.
+    """
+
+    def __init__(self, path: Path):
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                fname TEXT PRIMARY KEY,
+                titles TEXT NOT NULL,
+                url_count INTEGER NOT NULL,
+                shard INTEGER NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pages_shard ON pages (shard)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS result_hashes (fname TEXT PRIMARY KEY, hash TEXT NOT NULL)")
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self) -> int:
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM pages").fetchone()
+        return count
+
+    @property
+    def backfilled(self) -> bool:
+        # pages published before the index existed are only in data/result
+        return self._conn.execute("SELECT 1 FROM meta WHERE key = 'backfilled'").fetchone() is not None
+
+    def mark_backfilled(self):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('backfilled', '1')")
+
+    def update(self, fname: str, titles: list[str]):
+        encoded = json.dumps(titles, ensure_ascii=False)
+        # IMMEDIATE: concurrent publishers must not assign shards from the same snapshot
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            updated = self._conn.execute(
+                "UPDATE pages SET titles = ?, url_count = ? WHERE fname = ?",
+                (encoded, len(titles), fname),
+            ).rowcount
+            if not updated:
+                shard, url_count = self._conn.execute(
+                    "SELECT COALESCE(MAX(shard), 0), (SELECT COALESCE(SUM(url_count), 0) FROM pages WHERE shard = (SELECT MAX(shard) FROM pages)) FROM pages"
+                ).fetchone()
+                if url_count + len(titles) > SHARD_TARGET_URLS:
+                    shard += 1
+                self._conn.execute(
+                    "INSERT INTO pages (fname, titles, url_count, shard) VALUES (?, ?, ?, ?)",
+                    (fname, encoded, len(titles), shard),
+                )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def get_result_hash(self, fname: str) -> str | None:
+        # of the result last published, so that unchanged pages are not rendered again
+        row = self._conn.execute("SELECT hash FROM result_hashes WHERE fname = ?", (fname,)).fetchone()
+        return row[0] if row else None
+
+    def set_result_hash(self, fname: str, result_hash: str):
+        self._conn.execute("INSERT OR REPLACE INTO result_hashes (fname, hash) VALUES (?, ?)", (fname, result_hash))
+
+    def shards(self) -> dict[int, list[str]]:
+        shards: dict[int, list[str]] = {}
+        for shard, titles in self._conn.execute("SELECT shard, titles FROM pages ORDER BY shard, fname"):
+            shards.setdefault(shard, []).extend(json.loads(titles))
+        return shards
+
+
+def open_title_index() -> TitleIndex:
+    path = Path(os.environ.get("JAKO_TITLE_INDEX_PATH", "data/title_index.sqlite3"))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return TitleIndex(path)
@@ -0,0 +1,46 @@
+from functools import lru_cache
+import os
+from typing import Protocol
+
+import tiktoken
+
+
+class TokenCounter(Protocol):
+    name: str
+
+    def count(self, text: str) -> int: ...
+
+
+class CharCounter:
+    name = "chars"
+
+    def count(self, text: str) -> int:
+        return len(text)
+
+
+class TiktokenCounter:
+    """
+    Approximates model token counts with a tiktoken encoding.
+
+    Counts are cached per text, since the same HTML fragments (closing tags,
+    list items, template markup) repeat a lot within and across pages.
+    """
+
+    def __init__(self, encoding: str = "o200k_base", cache_size: int = 1 << 16):
+        self.name = encoding
+        self._encoding = tiktoken.get_encoding(encoding)
+        self.count = lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text: str) -> int:
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+
+_default_counter: TokenCounter | None = None
+
+
+def default_counter() -> TokenCounter:
+    global _default_counter
+    if _default_counter is None:
+        encoding = os.environ.get("JAKO_TOKEN_ENCODING", "o200k_base")
+        _default_counter = CharCounter() if encoding == "chars" else TiktokenCounter(encoding)
+    return _default_counter
@@ -1,119 +1,328 @@
 import argparse
 import asyncio
-from itertools import batched
+from contextlib import closing
+import hashlib
 import json
+import os
 from pathlib import Path
 import traceback
+from typing import Iterator
 
-from jako.cache import Cache
-from jako.llm import GoogleGenaiClient
+from jako.cache import BaseCache, Cache, SharedCache, TieredCache, open_shared_cache
+from jako.files import atomic_write_text
+from jako.glossary_store import open_glossary_store
+from jako.llm import EchoClient, LLMClient, create_backend
 from jako.models.page import PageData
-from jako.preprocess_html import BrokenHtmlError, TagMismatchError, preprocess_split_html, recover_start_end_tags, restore_html
-from jako.prompts.glossary import glossary
+from jako.preprocess_html import BrokenHtmlError, PreprocessedSection, TagMismatchError, globalize_node_ids, iter_preprocess_split_html, localize_node_ids, recover_start_end_tags, restore_html, validate_chunk
+from jako.preprocessed import PREPROCESSOR_VERSION, artifact_path_for, artifact_writer, read_artifact
+from jako.prompts.glossary import Glossary, build_glossary
+from jako.ratelimit import holds_slot
+from jako.tokens import default_counter
 
 
-async def process(input_path: Path, overwrite: bool = False):
-    result_path = Path("data/result") / input_path.name
-    if result_path.exists() and not overwrite:
-        print(f"Result file {result_path} already exists. Use --overwrite to overwrite.")
-        return
-    
-    data = PageData.model_validate_json(input_path.read_text())
+SYSTEM_PROMPT = "You are a professional Japanese to Korean translator."\
+    "Don't use Kanji,Hiragana,Katakana.Only use Hangul."\
+    "Keep all HTML tags, especially keep id attributes.Do NOT add new HTML tags."\
+    "Try to transliterate names in Japanese language to Hangul."\
+    "Don't ask to continue translation.Don't explain about translation."\
+    "Don't stop translation early."
+
+TRANSLATE_INSTRUCTION = "\n\n위 내용을 자연스러운 한국어로 번역하라.\n\n"
+
+MAX_OUTPUT_TOKENS = 8192
+
+# chunks are cut by tokens, not characters, so their boundaries (and thus the
+# prompts that responses are cached by) differ from the ones cut by the old
+# character limit: the entries in the legacy data/cache/<pageid>.json files
+# no longer match, and pages cached there are translated again once
+CHUNK_TOKENS = 2048
+
+# Korean output takes more tokens than the Japanese input in most tokenizers
+OUTPUT_TOKENS_PER_INPUT_TOKEN = 2
+
+MIN_OUTPUT_TOKENS = 256
+
+TEMPERATURE = 0.2
+
+
+def create_client() -> LLMClient:
+    backend = os.environ.get("JAKO_LLM_BACKEND", "gemini")
+    if backend == "echo":
+        # echo back only the chunk, so that the result can be restored
+        return EchoClient.from_env(echo_until=TRANSLATE_INSTRUCTION)
+    return create_backend(backend)
+
+
+def result_path_for(input_path: Path) -> Path:
+    return Path("data/result") / input_path.name
+
 
+def open_cache(data: PageData, shared_cache: SharedCache) -> BaseCache:
     cache_path = Path("data/cache") / f"{data.page.pageid}.json"
     cache_path.parent.mkdir(parents=True, exist_ok=True)
     print("Using cache:", cache_path)
-    cache = Cache(cache_path)
+    # per-page caches are only read; new responses go to the shared cache.
+    # Only chunks whose prompt didn't change since then still hit them (see CHUNK_TOKENS)
+    return TieredCache([shared_cache, Cache(cache_path)])
 
-    chunks, restore_info = preprocess_split_html(
+
+def preprocess(data: PageData, artifact_path: Path | None = None) -> Iterator[PreprocessedSection]:
+    # with artifact_path, sections are loaded from there if they are up to date,
+    # and written there otherwise
+    counter = default_counter()
+    key = {
+        "version": PREPROCESSOR_VERSION,
+        "revid": data.page.revid,
+        "chunk_tokens": CHUNK_TOKENS,
+        "token_encoding": counter.name,
+    }
+    if artifact_path:
+        sections = read_artifact(artifact_path, key)
+        if sections is not None:
+            yield from sections
+            return
+
+    sections = iter_preprocess_split_html(
         data.page.text,
         data.page.title,
-        4096,
+        CHUNK_TOKENS,
         keep_cite_ref_a=True,
+        length=counter.count,
     )
-    print(f"{len(chunks)=}")
+    if not artifact_path:
+        yield from sections
+        return
+    # written one section at a time; if the caller stops early, the partial
+    # artifact is discarded
+    with artifact_writer(artifact_path, key) as write_section:
+        for section in sections:
+            write_section(section)
+            yield section
+
 
-    client = GoogleGenaiClient()
+def preprocess_file(input_path: Path):
+    data = PageData.model_validate_json(input_path.read_text())
+    for _ in preprocess(data, artifact_path_for(input_path)):
+        pass
 
-    system_prompt = "You are a professional Japanese to Korean translator."\
-        "Don't use Kanji,Hiragana,Katakana.Only use Hangul."\
-        "Keep all HTML tags, especially keep id attributes.Do NOT add new HTML tags."\
-        "Try to transliterate names in Japanese language to Hangul."\
-        "Don't ask to continue translation.Don't explain about translation."\
-        "Don't stop translation early."
 
-    max_output_tokens = 8192    
+def build_chunk_args(data: PageData, chunks: list[str], model: str, page_glossary: Glossary | None = None) -> list[dict]:
+    counter = default_counter()
+    if page_glossary is None:
+        with closing(open_glossary_store()) as store:
+            page_glossary = build_glossary(data, store)
     chunk_args = []
     for i, chunk in enumerate(chunks):
-        prompt = chunk + "\n\n위 내용을 자연스러운 한국어로 번역하라.\n\n" + glossary(chunk, data)
-        if len(prompt) > max_output_tokens:
-            raise ValueError(f"chunk {i} is too large: {len(prompt)}")
+        # the prompt depends only on the chunk's content, not on where it is in the page
+        local_chunk, node_ids = localize_node_ids(chunk)
+        prompt = local_chunk + TRANSLATE_INSTRUCTION + page_glossary.prompt(local_chunk)
+        chunk_tokens = counter.count(local_chunk)
+        if chunk_tokens * OUTPUT_TOKENS_PER_INPUT_TOKEN > MAX_OUTPUT_TOKENS:
+            raise ValueError(f"chunk {i} is too large: {chunk_tokens} tokens")
         chunk_args.append({
-            "model": "gemini-2.0-flash-lite",
-            "contents": prompt,
-            "config": {
-                "system_instruction": system_prompt,
-                "max_output_tokens": min(len(prompt), max_output_tokens),
-                "temperature": 0.2,
-            },
+            "chunk": local_chunk,
+            "node_ids": node_ids,
+            "model": model,
+            "prompt": prompt,
+            "max_output_tokens": min(max(chunk_tokens * OUTPUT_TOKENS_PER_INPUT_TOKEN, MIN_OUTPUT_TOKENS), MAX_OUTPUT_TOKENS),
             "retry_count": 0,
         })
+    return chunk_args
+
+
+async def process(
+    input_path: Path,
+    overwrite: bool = False,
+    client: LLMClient | None = None,
+    refresh: bool = False,
+    shared_cache: SharedCache | None = None,
+):
+    """
+    Translates the page at `input_path`.
+
+    Pass `shared_cache` to share it (and its connection) between pages;
+    otherwise one is opened for this page.
+
+    With `refresh`, an existing result is re-translated only if the source has
+    a newer revision, and sections that didn't change since the previous
+    translation are reused from its sidecar instead of being sent to the LLM.
+    """
+    result_path = result_path_for(input_path)
+    if result_path.exists() and not overwrite and not refresh:
+        print(f"Result file {result_path} already exists. Use --overwrite to overwrite.")
+        return
     
-    while True:
-        responses: list[GoogleGenaiClient.GenerateContentResponse] = []
-        for i, batch in enumerate(batched(chunk_args, 4)):
-            print(f"batch {i}...")
-            tasks = [
-                client.agenerate_content(
-                    model=chunk["model"],
-                    contents=chunk["contents"],
-                    config=chunk["config"],
-                    cache=cache,
-                )
-                for chunk in batch
-            ]
-            batch_responses = await asyncio.gather(*tasks, return_exceptions=True)
-            for r in batch_responses:
-                if isinstance(r, Exception):
-                    raise r
-                else:
-                    responses.append(r)
-
-        for i, r in enumerate(responses):
-            if r.candidates[0].finish_reason != "STOP":
-                raise Exception(f"Unexpected finish reason: {r.candidates[0].finish_reason} for chunk #{i}")
-
-        result_chunks = list(recover_start_end_tags(original, r.text) for original, r in zip(chunks, responses))
-        result_html = ''.join(result_chunks)
+    sections_path = result_sections_path_for(input_path)
+    previous = _read_result_sections(sections_path) if refresh else None
+    check_up_to_date = refresh and result_path.exists() and not overwrite
+    # results from before the sidecar was written: the source is only
+    # rewritten by the scraper when the page has a new revision
+    if check_up_to_date and previous is None and result_path.stat().st_mtime >= input_path.stat().st_mtime:
+        print(f"Result file {result_path} is up to date.")
+        return
+
+    data = PageData.model_validate_json(input_path.read_text())
+    if check_up_to_date and previous and previous["revid"] == data.page.revid:
+        print(f"Result file {result_path} is up to date.")
+        return
+
+    if shared_cache is None:
+        shared_cache = open_shared_cache()
         try:
-            result_html, result_title = restore_html(result_html, restore_info)
-        except BrokenHtmlError as e:
-            match = _find_broken_html_chunk_index(e, result_html, result_chunks)
-            if not match:
-                print("Broken chunk not found")
-                raise e
-            
-            error_chunk_index, _ = match
-            if chunk_args[error_chunk_index]["retry_count"] > 0:
-                _print_broken_html_error(e, chunks, result_chunks, result_html)
-                raise e
-            print(f"Retrying error chunk {error_chunk_index}")
-            chunk_args[error_chunk_index]["retry_count"] += 1
-            chunk_args[error_chunk_index]["model"] = "gemini-2.0-flash"
-        else:
-            break
+            return await _process(input_path, data, previous, refresh, client, shared_cache)
+        finally:
+            shared_cache.close()
+    return await _process(input_path, data, previous, refresh, client, shared_cache)
+
+
+async def _process(input_path: Path, data: PageData, previous: dict | None, refresh: bool, client: LLMClient | None, shared_cache: SharedCache):
+    result_path = result_path_for(input_path)
+    sections_path = result_sections_path_for(input_path)
+    previous_sections = previous["sections"] if previous else {}
+    cache = open_cache(data, shared_cache)
+    with closing(open_glossary_store()) as store:
+        page_glossary = build_glossary(data, store)
 
-    result_path.write_text(json.dumps({
+    client = client or create_client()
+
+    # sections are translated as soon as they are preprocessed
+    async with asyncio.TaskGroup() as tg:
+        section_results = []
+        pending_title = data.page.title
+        reused = 0
+        for section in preprocess(data, artifact_path_for(input_path)):
+            if section.restore_info is None:
+                section_results.append((None, (section.source, "")))
+                continue
+            # the title is translated with the first section
+            key = section_hash(section, pending_title)
+            pending_title = ""
+            if key in previous_sections:
+                reused += 1
+                result = previous_sections[key]
+                section_results.append((key, (result["html"], result["title"])))
+                continue
+            section_results.append((key, tg.create_task(_translate_section(client, cache, data, page_glossary, section))))
+            # let the section's requests go out before preprocessing the next one
+            await asyncio.sleep(0)
+        if refresh:
+            print(f"Reusing {reused}/{sum(key is not None for key, _ in section_results)} sections")
+
+    result_title = ""
+    result_parts = []
+    result_sections = {}
+    for key, result in section_results:
+        html, title = result.result() if isinstance(result, asyncio.Task) else result
+        result_parts.append(html)
+        result_title = result_title or title
+        if key is not None:
+            result_sections[key] = {"html": html, "title": title}
+    result_html = ''.join(result_parts)
+
+    atomic_write_text(result_path, json.dumps({
         "title": result_title,
         "html": result_html,
     }))
+    sections_path.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write_text(sections_path, json.dumps({
+        "revid": data.page.revid,
+        "sections": result_sections,
+    }, ensure_ascii=False))
+
 
-    # cache.flush()
+def result_sections_path_for(input_path: Path) -> Path:
+    return Path("data/result_sections") / input_path.name
+
+
+def section_hash(section: PreprocessedSection, title: str = "") -> str:
+    return hashlib.sha256(f"{title}\0{section.source}".encode()).hexdigest()
+
+
+def _read_result_sections(path: Path) -> dict | None:
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return None
+
+
+async def _translate_section(client: LLMClient, cache: BaseCache, data: PageData, page_glossary: Glossary, section: PreprocessedSection) -> tuple[str, str]:
+    chunks = section.chunks
+    chunk_args = build_chunk_args(data, chunks, client.default_model, page_glossary)
+    result_chunks = await _translate_chunks(client, cache, chunk_args)
+    result_html = ''.join(result_chunks)
+    try:
+        return restore_html(result_html, section.restore_info)
+    except BrokenHtmlError as e:
+        match = _find_broken_html_chunk_index(e, result_html, result_chunks)
+        if not match:
+            print("Broken chunk not found")
+        else:
+            error_chunk_index, pos_in_result_chunk = match
+            _print_broken_html_error(e, chunks[error_chunk_index], result_chunks[error_chunk_index], pos_in_result_chunk)
+        raise
+
+
+async def _translate_chunks(client: LLMClient, cache: BaseCache, chunk_args: list[dict]) -> list[str]:
+    # all chunks are queued at once; the client's limiter decides how many run
+    # concurrently, so a slow chunk doesn't hold back the others
+    failed = False
+
+    async def translate_chunk(i: int):
+        args = chunk_args[i]
+        while True:
+            r = await client.agenerate(
+                model=args["model"],
+                prompt=args["prompt"],
+                system_instruction=SYSTEM_PROMPT,
+                max_output_tokens=args["max_output_tokens"],
+                temperature=TEMPERATURE,
+                cache=cache,
+            )
+            if not r.complete:
+                raise Exception(f"Unexpected finish reason: {r.finish_reason} for chunk #{i}")
+            result_chunk = recover_start_end_tags(args["chunk"], r.text)
+            try:
+                validate_chunk(args["chunk"], result_chunk)
+                global_result_chunk = globalize_node_ids(result_chunk, args["node_ids"])
+            except BrokenHtmlError as e:
+                if args["retry_count"] > 0:
+                    _print_broken_html_error(e, args["chunk"], result_chunk, _node_pos(e.node, result_chunk))
+                    raise
+                if failed:
+                    raise
+                print(f"Retrying error chunk {i}: {e}")
+                args["retry_count"] += 1
+                args["model"] = client.fallback_model
+                continue
+            return i, global_result_chunk
+
+    tasks = [asyncio.create_task(translate_chunk(i)) for i in range(len(chunk_args))]
+    result_chunks = [""] * len(chunk_args)
+    try:
+        for done_count, task in enumerate(asyncio.as_completed(tasks), 1):
+            i, result_chunk = await task
+            result_chunks[i] = result_chunk
+            if done_count % 10 == 0 or done_count == len(tasks):
+                print(f"translated {done_count}/{len(tasks)} chunks")
+    except BaseException:
+        # also when another section failed and cancelled us. Requests that
+        # were already sent are billed: let them finish so that their
+        # responses are cached for the next attempt, and drop the queued ones
+        failed = True
+        for task in tasks:
+            if not holds_slot(task):
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return result_chunks
+
+
+def _node_pos(node, html: str) -> int:
+    return sum(len(line) for line in html.splitlines(keepends=True)[:node.sourceline - 1]) + node.sourcepos
 
 
 def _find_broken_html_chunk_index(e: BrokenHtmlError, result_html, result_chunks):
-    sourceline, sourcepos = e.node.sourceline, e.node.sourcepos
-    pos = sum(len(line) for line in result_html.splitlines(keepends=True)[:sourceline - 1]) + sourcepos
+    pos = _node_pos(e.node, result_html)
     result_chunk_start = 0
     for i, result_chunk in enumerate(result_chunks):
         next_result_chunk_start = result_chunk_start + len(result_chunk)
@@ -123,49 +332,59 @@ def _find_broken_html_chunk_index(e: BrokenHtmlError, result_html, result_chunks
     return None
 
 
-def _print_broken_html_error(e: BrokenHtmlError, chunks, result_chunks, result_html):
-    match = _find_broken_html_chunk_index(e, result_html, result_chunks)
-    if not match:
-        print("Tag mismatch chunk not found")
-        return
-    
+def _print_broken_html_error(e: BrokenHtmlError, original_chunk: str, result_chunk: str, pos_in_result_chunk: int):
+    print(str(e))
     if isinstance(e, TagMismatchError):
-        error_chunk_index, pos_in_result_chunk = match
-        result_chunk = result_chunks[error_chunk_index]
-        original_chunk = chunks[error_chunk_index]
         pos_in_original_chunk = original_chunk.find(f"<{e.expected_tag} id=\"{e.node_id}\"")
-        print(str(e))
         if pos_in_original_chunk == -1:
             print("Original tag not found")
         else:
             print(f"Original:   {repr(original_chunk[max(pos_in_original_chunk-20, 0):min(pos_in_original_chunk+200, len(original_chunk))])}")
-        print(f"Translated: {repr(result_chunk[max(pos_in_result_chunk-20, 0):min(pos_in_result_chunk+200, len(result_chunk))])}")
+    print(f"Translated: {repr(result_chunk[max(pos_in_result_chunk-20, 0):min(pos_in_result_chunk+200, len(result_chunk))])}")
 
 
-async def main(args):
-    input_path = Path(args.input)
+def read_input_paths(input_path: Path) -> list[Path]:
+    if input_path.suffix != ".csv":
+        return [input_path]
 
     input_paths = []
-    if input_path.suffix == ".csv":
-        with open(input_path) as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                input_paths.append(Path("data/source") / f"{line.replace('/', '__')}.json")
-    else:
-        input_paths = [input_path]
-    
-    for input_path in input_paths:
-        print(f"Processing {input_path}")
-        try:
-            await process(input_path, overwrite=args.overwrite)
-        except Exception:
-            traceback.print_exc()
+    with open(input_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            input_paths.append(Path("data/source") / f"{line.replace('/', '__')}.json")
+    return input_paths
+
+
+async def main(args, client: LLMClient | None = None):
+    input_paths = read_input_paths(Path(args.input))
+    if args.preprocess_only:
+        for input_path in input_paths:
+            print(f"Preprocessing {input_path}")
+            try:
+                preprocess_file(input_path)
+            except Exception:
+                traceback.print_exc()
+        return
+
+    client = client or create_client()
+    shared_cache = open_shared_cache()
+    try:
+        for input_path in input_paths:
+            print(f"Processing {input_path}")
+            try:
+                await process(input_path, overwrite=args.overwrite, client=client, refresh=args.refresh, shared_cache=shared_cache)
+            except Exception:
+                traceback.print_exc()
+    finally:
+        shared_cache.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("input", help="Input file")
     parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--refresh", action="store_true", help="Re-translate changed sections of updated pages")
+    parser.add_argument("--preprocess-only", action="store_true", help="Only write preprocessed artifacts")
     asyncio.run(main(parser.parse_args()))
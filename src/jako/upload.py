@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import os
+from pathlib import Path
+import sqlite3
+import time
+from typing import Iterable
+
+BUCKET = "jako-data-kr"
+
+
+class UploadManifest:
+    """
+    ETag of every object uploaded to the bucket (SQLite), so that unchanged
+    files are not uploaded again.
+
+    ETags of single-part uploads are the MD5 of the content, which is what
+    we compare local files with.
+    """
+
+    def __init__(self, path: Path):
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS objects (
+                key TEXT PRIMARY KEY,
+                etag TEXT NOT NULL,
+                uploaded_at REAL NOT NULL
+            )
+        """)
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self) -> int:
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM objects").fetchone()
+        return count
+
+    def get_etag(self, key: str) -> str | None:
+        row = self._conn.execute("SELECT etag FROM objects WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_etags(self, etags: Iterable[tuple[str, str]]):
+        now = time.time()
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO objects (key, etag, uploaded_at) VALUES (?, ?, ?)",
+            ((key, etag, now) for key, etag in etags),
+        )
+
+    def seed_from_bucket(self, client, bucket: str = BUCKET):
+        # start from what is already in the bucket instead of uploading everything once
+        paginator = client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket):
+            self.set_etags((obj["Key"], obj["ETag"].strip('"')) for obj in page.get("Contents", []))
+
+
+def open_upload_manifest() -> UploadManifest:
+    path = Path(os.environ.get("JAKO_UPLOAD_MANIFEST_PATH", "data/upload_manifest.sqlite3"))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return UploadManifest(path)
+
+
+def upload_changed(
+    files: Iterable[tuple[Path, str]],
+    client,
+    manifest: UploadManifest,
+    bucket: str = BUCKET,
+    max_workers: int | None = None,
+) -> list[str]:
+    """
+    Uploads the (path, key) pairs whose content differs from the manifest,
+    concurrently, and returns the uploaded keys.
+    """
+    # only the paths are kept; each body is read by the worker that uploads it
+    pending = []
+    for path, key in files:
+        with path.open("rb") as f:
+            etag = hashlib.file_digest(f, "md5").hexdigest()
+        if manifest.get_etag(key) != etag:
+            pending.append((path, key, etag))
+    if not pending:
+        return []
+
+    def upload(path: Path, key: str, etag: str) -> tuple[str, str]:
+        client.put_object(Bucket=bucket, Key=key, Body=path.read_bytes())
+        return key, etag
+
+    max_workers = max_workers or int(os.environ.get("JAKO_UPLOAD_CONCURRENCY", "16"))
+    uploaded = []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(pending))) as executor:
+        futures = [executor.submit(upload, *item) for item in pending]
+        try:
+            for future in as_completed(futures):
+                key, etag = future.result()
+                # recorded as they complete, so that a failure doesn't lose the others
+                manifest.set_etags([(key, etag)])
+                uploaded.append(key)
+                print(f"Uploaded to S3: {key}")
+        finally:
+            for future in futures:
+                future.cancel()
+    return uploaded
@@ -1,3 +1,4 @@
+from functools import lru_cache
 import json
 import os
 from pathlib import Path
@@ -8,7 +9,9 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
 from jako.models.page import PageData
-from jako.preprocess_html import fix_cite_ref_a, preprocess_split_html, restore_html
+from jako.preprocess_html import RestoreInfo, fix_cite_ref_a, restore_html
+from jako.preprocessed import artifact_path_for
+from jako.translate import preprocess
 
 app = FastAPI()
 
@@ -41,16 +44,23 @@ def result_view(request: Request, page: str):
     if not result_path.exists():
         return RedirectResponse(url=f"https://ja.wikipedia.org/wiki/{urllib.parse.quote(page)}")
 
-    data = json.loads(result_path.read_text())
+    title, html = _load_result(result_path, result_path.stat().st_mtime)
     return templates.TemplateResponse(
         request=request, name="result.html", context={
             "page": page,
-            "title": data["title"],
-            "html": fix_cite_ref_a(data["html"]),
+            "title": title,
+            "html": html,
         }
     )
 
 
+@lru_cache(maxsize=64)
+def _load_result(result_path: Path, mtime: float) -> tuple[str, str]:
+    # keyed by mtime so that re-translated results are picked up
+    data = json.loads(result_path.read_text())
+    return data["title"], fix_cite_ref_a(data["html"])
+
+
 @app.get("/source", response_class=HTMLResponse)
 def source_list_view(request: Request):
     pages = []
@@ -68,8 +78,13 @@ def source_view(request: Request, page: str, debug: bool = False):
     source_path = Path("data/source") / f"{page}.json"
     
     data = PageData.model_validate_json(source_path.read_text())
-    chunks, restore_info = preprocess_split_html(data.page.text, title=data.page.title, size=4096, keep_cite_ref_a=True)
-    def _try_restore(chunk: str) -> str:
+    chunks = [
+        (chunk, section.restore_info)
+        for section in preprocess(data, artifact_path_for(source_path))
+        if section.restore_info is not None
+        for chunk in section.chunks
+    ]
+    def _try_restore(chunk: str, restore_info: RestoreInfo) -> str:
         try:
             return restore_html(chunk, restore_info)[0]
         except Exception as e:
@@ -77,7 +92,7 @@ def source_view(request: Request, page: str, debug: bool = False):
     return templates.TemplateResponse(
         request=request, name="source.html", context={
             "data": data,
-            "chunks": [{"raw": chunk, "restored": _try_restore(chunk)} for chunk in chunks],
+            "chunks": [{"raw": chunk, "restored": _try_restore(chunk, restore_info)} for chunk, restore_info in chunks],
         }
     )
 
@@ -1,15 +1,22 @@
 import asyncio
+from datetime import datetime, timezone
+from itertools import batched
+import json
 import os
 from pathlib import Path
-from celery import Celery
+from celery import Celery, Signature, chain
 from celery.schedules import crontab
 
-from jako.publish import indexnow_batch, page_url, publish_page, publish_sitemap as do_publish_sitemap
-from jako.scrape import batch_get_page_infos, download_page, get_category_members
-from jako.translate import process as translate_file
-import boto3
+from jako.files import append_lines_locked
+from jako.cache import open_shared_cache
+from jako.glossary_store import open_glossary_store
+from jako.indexnow import open_indexnow_queue
+from jako.publish import page_url, publish_dir, publish_page, publish_sitemap as do_publish_sitemap, safe_filename, upload_published
+from jako.ratelimit import backoff_delay
+from jako.scrape import abatch_get_page_infos, adownload_page, crawl_category, crawl_state_path_for
+from jako.translate import create_client, process as translate_file
 
-app = Celery("jako.worker", broker=os.environ["CELERY_BROKER"], backend="db+sqlite:///data/worker/backend.sqlite3")
+app = Celery("jako.worker", broker=os.environ["CELERY_BROKER"], backend=os.environ.get("CELERY_BACKEND", "db+sqlite:///data/worker/backend.sqlite3"))
 app.conf.worker_prefetch_multiplier = 1
 
 # https://docs.celeryq.dev/en/stable/userguide/routing.html#redis-message-priorities
@@ -18,6 +25,20 @@ app.conf.broker_transport_options = {
 }
 app.conf.task_default_priority = 5
 
+# run a worker per queue with its own concurrency, e.g.
+#   celery -A jako.worker worker -Q scrape -c 2          (Wikipedia API limits)
+#   celery -A jako.worker worker -Q translate -c 4       (LLM quota; pages in a task run concurrently)
+#   celery -A jako.worker worker -Q publish,celery -c 2 -B
+# or a single worker with -Q scrape,translate,publish,celery
+app.conf.task_routes = {
+    "jako.worker.scrape_pages": {"queue": "scrape"},
+    "jako.worker.translate_category": {"queue": "scrape"},
+    "jako.worker.translate_pages": {"queue": "translate"},
+    "jako.worker.publish_pages": {"queue": "publish"},
+    "jako.worker.publish_sitemap": {"queue": "publish"},
+    "jako.worker.flush_indexnow": {"queue": "publish"},
+}
+
 app.conf.beat_schedule = {
     'publish sitemap if changed': {
         'task': 'jako.worker.publish_sitemap',
@@ -25,43 +46,159 @@ app.conf.beat_schedule = {
         'args': (),
         'options': {'priority': 1},  # high priority
     },
+    'flush IndexNow queue if due': {
+        'task': 'jako.worker.flush_indexnow',
+        'schedule': 60,
+        'args': (),
+        'options': {'priority': 1},
+    },
 }
 
-s3 = boto3.client("s3")
+# pages per translate_batch task
+BATCH_SIZE = 20
+
+# pages that failed a stage are enqueued again on their own, up to this many
+# attempts; then they are recorded in FAILED_PAGES_PATH
+MAX_PAGE_ATTEMPTS = 3
+
+FAILED_PAGES_PATH = Path("data/worker/failed_pages.jsonl")
 
 
 @app.task
-def translate(title: str):
-    infos = batch_get_page_infos([title])
-    info = infos[title]
-    download_page(title, info)
-    
-    filename = f"{title.replace('/', '__')}.json"
-    input_path = Path("data/source") / filename
-    asyncio.run(translate_file(input_path))
-
-    result = publish_page(filename)
-    titles = [result.translated_title]
-    if result.translated_redirect_title:
-        titles.append(result.translated_redirect_title)
-    titles.extend(result.redirect_titles)
-
-    for t in titles:
-        publish_path = Path("data/publish") / f"{t.replace('/', '__')}.json"
-        s3.upload_file(str(publish_path), "jako-data-kr", publish_path.name)
-        print(f"Uploaded to S3: {publish_path}")
-
-    print("Calling IndexNow API...")
-    indexnow_batch([page_url(t) for t in titles])
+def translate(title: str, refresh: bool = False):
+    translate_batch([title], refresh=refresh)
 
 
 @app.task
-def translate_category(category: str):
-    for page in get_category_members(category):
-        # TODO: batching?
-        translate.delay(page["title"])
+def translate_batch(titles: list[str], refresh: bool = False):
+    _pipeline(titles, refresh=refresh).delay()
+
+
+def _pipeline(titles: list[str], refresh: bool = False, stage: str = "scrape", attempt: int = 1) -> Signature:
+    # each stage runs on its own queue; a failed stage is retried without re-running the earlier ones
+    if stage == "scrape":
+        stages = [scrape_pages.s(titles, refresh=refresh, attempt=attempt), translate_pages.s(refresh=refresh)]
+    else:
+        stages = [translate_pages.s(titles, refresh=refresh, attempt=attempt)]
+    return chain(*stages, publish_pages.s())
+
+
+class PagesFailed(Exception):
+    pass
+
+
+# PagesFailed: the failed pages are already enqueued again by _successful
+@app.task(autoretry_for=(Exception,), dont_autoretry_for=(PagesFailed,), retry_backoff=True, max_retries=3)
+def scrape_pages(titles: list[str], refresh: bool = False, attempt: int = 1) -> list[str]:
+    results = asyncio.run(_scrape_pages(titles, refresh=refresh))
+    return _successful(titles, results, "scrape", refresh, attempt)
+
+
+async def _scrape_pages(titles: list[str], refresh: bool = False) -> list:
+    # one page info query and glossary store for the batch
+    infos = await abatch_get_page_infos(titles)
+    store = open_glossary_store()
+
+    async def download(title: str):
+        # e.g. a title that the API normalized; only this page fails
+        info = infos.get(title)
+        if info is None:
+            raise KeyError(f"page info not found: {title}")
+        await adownload_page(title, info, refresh=refresh, store=store)
+
+    try:
+        return await asyncio.gather(*(download(title) for title in titles), return_exceptions=True)
+    finally:
+        store.close()
+
+
+@app.task
+def translate_pages(titles: list[str], refresh: bool = False, attempt: int = 1) -> list[str]:
+    results = asyncio.run(_translate_pages(titles, refresh=refresh))
+    return _successful(titles, results, "translate", refresh, attempt)
+
+
+async def _translate_pages(titles: list[str], refresh: bool = False) -> list:
+    # one LLM client (and rate limiter) and shared cache for the batch, so
+    # that identical chunks in different pages are requested only once
+    client = create_client()
+    shared_cache = open_shared_cache()
+    try:
+        return await asyncio.gather(*(
+            translate_file(Path("data/source") / f"{title.replace('/', '__')}.json", refresh=refresh, client=client, shared_cache=shared_cache)
+            for title in titles
+        ), return_exceptions=True)
+    finally:
+        shared_cache.close()
+
+
+def _successful(titles: list[str], results: list, stage: str, refresh: bool, attempt: int) -> list[str]:
+    """
+    Returns the titles that succeeded, to be passed to the next stage.
+
+    The failed ones are enqueued again from this stage, or recorded in
+    FAILED_PAGES_PATH after MAX_PAGE_ATTEMPTS.
+    """
+    succeeded = []
+    failed = {}
+    for title, result in zip(titles, results):
+        if isinstance(result, BaseException):
+            print(f"Failed to {stage} {title}: {result!r}")
+            failed[title] = result
+        else:
+            succeeded.append(title)
+    if not failed:
+        return succeeded
+
+    if attempt < MAX_PAGE_ATTEMPTS:
+        countdown = max(60, backoff_delay(attempt, base=60, cap=60 * 60))
+        print(f"Retrying {len(failed)} pages from {stage} in {countdown:.0f} seconds")
+        _pipeline(list(failed), refresh=refresh, stage=stage, attempt=attempt + 1).apply_async(countdown=countdown)
+    else:
+        record_failed_pages(failed, stage)
+    if not succeeded:
+        # shows up as a failure in Celery; the chain stops here
+        raise PagesFailed(f"Failed to {stage} all {len(titles)} pages: {list(failed)}")
+    return succeeded
+
+
+def record_failed_pages(failed: dict[str, BaseException], stage: str):
+    FAILED_PAGES_PATH.parent.mkdir(parents=True, exist_ok=True)
+    failed_at = datetime.now(timezone.utc).isoformat()
+    append_lines_locked(FAILED_PAGES_PATH, [
+        json.dumps({"title": title, "stage": stage, "error": repr(error), "failed_at": failed_at}, ensure_ascii=False)
+        for title, error in failed.items()
+    ])
+
+
+@app.task(autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+def publish_pages(titles: list[str]):
+    published_titles = []
+    for title in titles:
+        result = publish_page(f"{title.replace('/', '__')}.json")
+        published_titles.append(result.translated_title)
+        if result.translated_redirect_title:
+            published_titles.append(result.translated_redirect_title)
+        published_titles.extend(result.redirect_titles)
+
+    # unchanged files (e.g. redirect stubs of re-translated pages) are skipped
+    upload_published(publish_dir / safe_filename(t) for t in published_titles)
+
+    # submitted in bulk by flush_indexnow
+    open_indexnow_queue().add(page_url(t) for t in published_titles)
+
+
+@app.task
+def translate_category(category: str, max_depth: int = 3):
+    for batch in batched(crawl_category(category, max_depth=max_depth, state_path=crawl_state_path_for(category)), BATCH_SIZE):
+        translate_batch.delay(list(batch))
 
 
 @app.task
 def publish_sitemap():
     do_publish_sitemap()
+
+
+@app.task
+def flush_indexnow():
+    open_indexnow_queue().flush_if_due()
@@ -0,0 +1,54 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+from typing import Callable
+
+import pytest
+
+from jako.models.page import Page, PageData, PageLanglinks, Redirect
+from jako.tokens import CharCounter
+
+
+@pytest.fixture
+def char_counter(monkeypatch):
+    # tiktoken downloads its encodings, so tests count characters
+    counter = CharCounter()
+    monkeypatch.setattr("jako.tokens._default_counter", counter)
+    return counter
+
+
+@pytest.fixture
+def make_page_data() -> Callable[..., PageData]:
+    def make_page_data(
+        title: str = "タイトル",
+        text: str = "",
+        revid: int = 1,
+        redirects: list[str] = [],
+        links_langlinks: list[PageLanglinks] = [],
+    ) -> PageData:
+        return PageData(
+            page=Page(
+                title=title, text=text, pageid=1, revid=revid, langlinks=[], links=[],
+                redirects=[Redirect(from_=r, to=title) for r in redirects],
+            ),
+            links_langlinks=links_langlinks,
+            last_rev_timestamp="2025-01-01T00:00:00Z",
+        )
+
+    return make_page_data
+
+
+@pytest.fixture
+def http_server() -> Callable[[type[BaseHTTPRequestHandler]], str]:
+    # serve_forever on a thread; returns the base URL
+    servers = []
+
+    def start(handler: type[BaseHTTPRequestHandler]) -> str:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,79 @@
+from http.server import BaseHTTPRequestHandler
+import json
+from pathlib import Path
+
+from jako.batch import GeminiBatchClient, prefill_cache
+from jako.cache import open_shared_cache
+from jako.llm import CACHE_SCOPE, GoogleGenaiClient, decode_response
+from jako.translate import SYSTEM_PROMPT, TEMPERATURE, build_chunk_args, preprocess
+
+
+class FakeBatchHandler(BaseHTTPRequestHandler):
+    # echoes each request's prompt back as the response text
+    jobs: dict[str, dict] = {}
+    log: list[str] = []
+
+    def do_POST(self):
+        self.log.append("POST")
+        body = json.loads(self.rfile.read(int(self.headers["content-length"])))
+        name = f"batches/{len(self.jobs)}"
+        responses = []
+        for item in body["batch"]["input_config"]["requests"]["requests"]:
+            text = item["request"]["contents"][0]["parts"][0]["text"]
+            responses.append({
+                "metadata": item["metadata"],
+                "response": {
+                    "candidates": [{"content": {"role": "model", "parts": [{"text": text.split("\n\n")[0]}]}, "finishReason": "STOP"}],
+                },
+            })
+        self.jobs[name] = {
+            "name": name,
+            "metadata": {"state": "BATCH_STATE_SUCCEEDED"},
+            "done": True,
+            "response": {"inlinedResponses": {"inlinedResponses": responses}},
+        }
+        self._send({"name": name, "metadata": {"state": "BATCH_STATE_PENDING"}})
+
+    def do_GET(self):
+        self.log.append("GET")
+        self._send(self.jobs[self.path.removeprefix("/v1beta/")])
+
+    def _send(self, data: dict):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_prefill_cache(tmp_path: Path, monkeypatch, char_counter, make_page_data, http_server):
+    monkeypatch.chdir(tmp_path)
+    source_path = tmp_path / "source.json"
+    data = make_page_data(text="<p>本文</p><p>二段落目</p><p>三段落目</p>")
+    source_path.write_text(data.model_dump_json(by_alias=True))
+
+    # one chunk per paragraph, one job per chunk
+    monkeypatch.setattr("jako.translate.CHUNK_TOKENS", 20)
+    monkeypatch.setattr("jako.batch.MAX_JOB_BYTES", 1)
+
+    prefill_cache([source_path], GeminiBatchClient(api_key="test", base_url=http_server(FakeBatchHandler)), poll_interval=0)
+    # all jobs are created before waiting for them
+    assert FakeBatchHandler.log == ["POST"] * 3 + ["GET"] * 3
+
+    chunks = [chunk for section in preprocess(data) for chunk in section.chunks]
+    cache = open_shared_cache()
+    for args in build_chunk_args(data, chunks, GoogleGenaiClient.default_model):
+        kwargs = GoogleGenaiClient.request_kwargs(
+            model=args["model"],
+            prompt=args["prompt"],
+            system_instruction=SYSTEM_PROMPT,
+            max_output_tokens=args["max_output_tokens"],
+            temperature=TEMPERATURE,
+        )
+        response, found = cache.lookup(CACHE_SCOPE, (), kwargs, decode_response)
+        assert found
+        assert response.text == args["chunk"]
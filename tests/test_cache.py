@@ -0,0 +1,127 @@
+import asyncio
+import json
+from pathlib import Path
+from jako.cache import Cache, SharedCache, TieredCache
+
+
+def _identity(x):
+    return x
+
+
+def test_cache_roundtrip(tmp_path: Path):
+    calls = []
+
+    def func(a, b=None):
+        calls.append((a, b))
+        return {"value": f"{a}-{b}"}
+
+    cache = Cache(tmp_path / "1.json")
+    wrapped = cache.wrap("scope", func, _identity, _identity)
+    assert wrapped(1, b="x") == {"value": "1-x"}
+    assert wrapped(1, b="x") == {"value": "1-x"}
+    assert len(calls) == 1
+
+    cache = Cache(tmp_path / "1.json")
+    wrapped = cache.wrap("scope", func, _identity, _identity)
+    assert wrapped(1, b="x") == {"value": "1-x"}
+    assert wrapped(2, b="x") == {"value": "2-x"}
+    assert len(calls) == 2
+    assert len((tmp_path / "1.jsonl").read_text().splitlines()) == 2
+
+
+def test_cache_loads_legacy_json(tmp_path: Path):
+    (tmp_path / "1.json").write_text(json.dumps({
+        "google": [
+            {"args": [], "kwargs": {"model": "m", "contents": "hi"}, "result": {"text": "안녕"}},
+        ],
+    }))
+    cache = Cache(tmp_path / "1.json")
+    assert cache.lookup("google", (), {"contents": "hi", "model": "m"}, _identity) == ({"text": "안녕"}, True)
+    assert cache.lookup("google", (), {"contents": "bye", "model": "m"}, _identity) == (None, False)
+    assert cache.lookup("openai", (), {"contents": "hi", "model": "m"}, _identity) == (None, False)
+
+
+def test_shared_cache_evicts_lru(tmp_path: Path):
+    cache = SharedCache(tmp_path / "shared.sqlite3", max_bytes=100)
+    cache.set("scope", ("a",), {}, "x" * 40, _identity)
+    cache.set("scope", ("b",), {}, "x" * 40, _identity)
+    assert cache.lookup("scope", ("a",), {}, _identity)[1]
+    cache.set("scope", ("c",), {}, "x" * 40, _identity)
+    cache.evict()
+    assert cache.lookup("scope", ("a",), {}, _identity)[1]
+    assert not cache.lookup("scope", ("b",), {}, _identity)[1]
+    assert cache.lookup("scope", ("c",), {}, _identity)[1]
+
+
+def test_tiered_cache_writes_to_first(tmp_path: Path):
+    page_cache = Cache(tmp_path / "1.json")
+    page_cache.set("scope", ("a",), {}, "page", _identity)
+    shared_cache = SharedCache(tmp_path / "shared.sqlite3")
+    cache = TieredCache([shared_cache, page_cache])
+    assert cache.lookup("scope", ("a",), {}, _identity) == ("page", True)
+    assert shared_cache.lookup("scope", ("a",), {}, _identity) == ("page", True)
+
+    cache.set("scope", ("b",), {}, "new", _identity)
+    assert shared_cache.lookup("scope", ("b",), {}, _identity) == ("new", True)
+    assert page_cache.lookup("scope", ("b",), {}, _identity) == (None, False)
+
+
+def test_cache_single_flight(tmp_path: Path):
+    calls = []
+
+    async def func(a):
+        calls.append(a)
+        await asyncio.sleep(0.01)
+        return a * 2
+
+    async def run():
+        wrapped = Cache(tmp_path / "1.json").wrap("scope", func, _identity, _identity)
+        return await asyncio.gather(wrapped(1), wrapped(1), wrapped(2))
+
+    assert asyncio.run(run()) == [2, 2, 4]
+    assert calls == [1, 2]
+
+
+def test_tiered_caches_share_single_flight(tmp_path: Path):
+    calls = []
+
+    async def func(a):
+        calls.append(a)
+        await asyncio.sleep(0.01)
+        return a * 2
+
+    async def run():
+        shared_cache = SharedCache(tmp_path / "shared.sqlite3")
+        # e.g. two pages translated in the same batch
+        wrapped = [
+            TieredCache([shared_cache, Cache(tmp_path / f"{pageid}.json")]).wrap("scope", func, _identity, _identity)
+            for pageid in (1, 2)
+        ]
+        return await asyncio.gather(wrapped[0](1), wrapped[1](1))
+
+    assert asyncio.run(run()) == [2, 2]
+    assert calls == [1]
+
+
+def test_cache_skips_torn_line(tmp_path: Path):
+    cache = Cache(tmp_path / "1.json")
+    cache.set("scope", ("a",), {}, "a", _identity)
+    cache.flush()
+    with (tmp_path / "1.jsonl").open("a") as f:
+        f.write('{"key": "torn')
+
+    cache = Cache(tmp_path / "1.json")
+    cache.set("scope", ("b",), {}, "b", _identity)
+    cache.flush()
+
+    cache = Cache(tmp_path / "1.json")
+    assert cache.lookup("scope", ("a",), {}, _identity) == ("a", True)
+    assert cache.lookup("scope", ("b",), {}, _identity) == ("b", True)
+
+
+def test_cache_sees_entries_from_other_writers(tmp_path: Path):
+    cache1 = Cache(tmp_path / "1.json")
+    cache2 = Cache(tmp_path / "1.json")
+    cache1.set("scope", ("a",), {}, "a", _identity)
+    cache1.flush()
+    assert cache2.lookup("scope", ("a",), {}, _identity) == ("a", True)
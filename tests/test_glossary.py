@@ -0,0 +1,71 @@
+import asyncio
+from datetime import timedelta
+from pathlib import Path
+import random
+
+from jako import scrape
+from jako.glossary_store import GlossaryStore
+from jako.models.page import Langlink, PageLanglinks
+from jako.prompts.glossary import Glossary, build_glossary
+
+
+def test_glossary_prompt():
+    glossary = Glossary([
+        ("東京都", "도쿄도"),
+        ("東京", "도쿄"),
+        ("日本", "일본"),  # blocklist
+        ("Tokyo", "도쿄"),  # latin only
+        ("2024年", "2024년"),  # date
+        ("京都", "교토"),
+        ("東京", "도쿄"),
+    ])
+    assert glossary.prompt("<p>東京都に住む</p>") == "Glossary:\n京都 -> 교토\n東京 -> 도쿄\n東京都 -> 도쿄도"
+    # independent of the order of the page's links
+    assert glossary.prompt("<p>東京都に住む</p>") == Glossary(reversed(glossary.entries)).prompt("<p>東京都に住む</p>")
+    assert glossary.prompt("<p>京都</p>") == "Glossary:\n京都 -> 교토"
+    assert glossary.prompt("<p>日本 Tokyo 2024年</p>") == ""
+    assert Glossary([]).prompt("東京") == ""
+
+
+def test_glossary_find():
+    rng = random.Random(0)
+    alphabet = "アイウエオカキ"
+    terms = {"".join(rng.choices(alphabet, k=rng.randint(1, 4))) for _ in range(200)}
+    glossary = Glossary([(term, term + "!") for term in terms])
+    for _ in range(50):
+        text = "".join(rng.choices(alphabet, k=rng.randint(0, 40)))
+        assert glossary.find(text) == {term for term in terms if term in text}
+
+
+def _langlinks(title: str, ko: str | None) -> PageLanglinks:
+    return PageLanglinks(pageid=hash(title) % 1000, ns=0, title=title, langlinks=[Langlink(lang="ko", title=ko)] if ko else None)
+
+
+def test_glossary_store(tmp_path: Path, monkeypatch):
+    store = GlossaryStore(tmp_path / "glossary.sqlite3", max_age=timedelta(days=1))
+    store.put_many([_langlinks("東京", "도쿄"), _langlinks("京都", None)])
+    assert store.get_ko_titles(["東京", "京都", "大阪"]) == {"東京": "도쿄", "京都": None}
+
+    fetched = []
+    async def abatch_get_page_langlinks(titles, lang, client):
+        fetched.extend(titles)
+        return [_langlinks(title, title + "?") for title in titles]
+    monkeypatch.setattr(scrape, "abatch_get_page_langlinks", abatch_get_page_langlinks)
+    links = asyncio.run(scrape.aget_links_langlinks(["大阪", "東京", "京都"], store))
+    assert fetched == ["大阪"]
+    assert [link.title for link in links] == ["大阪", "東京", "京都"]
+    assert store.get_ko_titles(["大阪"]) == {"大阪": "大阪?"}
+
+    # stale entries are fetched again
+    monkeypatch.setattr("time.time", lambda: 1e12)
+    fetched.clear()
+    asyncio.run(scrape.aget_links_langlinks(["東京"], store))
+    assert fetched == ["東京"]
+
+
+def test_build_glossary_from_store(tmp_path: Path, make_page_data):
+    store = GlossaryStore(tmp_path / "glossary.sqlite3")
+    data = make_page_data(links_langlinks=[_langlinks("東京", None), _langlinks("京都", "교토"), _langlinks("大阪", "오사카")])
+    store.put_many([_langlinks("東京", "도쿄"), _langlinks("京都", None)])
+    assert build_glossary(data, store).entries == [("東京", "도쿄"), ("大阪", "오사카")]
+    assert build_glossary(data).entries == [("京都", "교토"), ("大阪", "오사카")]
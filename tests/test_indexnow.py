@@ -0,0 +1,56 @@
+from datetime import timedelta
+from pathlib import Path
+
+from jako.indexnow import IndexNowQueue
+
+
+def test_indexnow_queue(tmp_path: Path, monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("time.time", lambda: now)
+    submitted = []
+    fail = False
+
+    def submit(urls: list[str]):
+        if fail:
+            raise ConnectionError("down")
+        submitted.append(urls)
+
+    path = tmp_path / "indexnow.sqlite3"
+    queue = IndexNowQueue(path, submit=submit, flush_size=3, flush_interval=timedelta(minutes=10))
+    queue.add(["a", "b"])
+    queue.add(["b"])
+    assert queue.pending_count() == 2
+    assert queue.flush_if_due() == 0
+
+    # pending URLs survive a restart
+    queue.close()
+    queue = IndexNowQueue(path, submit=submit, flush_size=3, flush_interval=timedelta(minutes=10))
+    queue.add(["c"])
+    assert queue.flush_if_due() == 3
+    assert submitted == [["a", "b", "c"]]
+
+    # flushed on a timer
+    queue.add(["d"])
+    assert queue.flush_if_due() == 0
+    now += 600
+    assert queue.flush_if_due() == 1
+
+    # retried with backoff
+    fail = True
+    queue.add(["e", "f", "g"])
+    assert queue.flush_if_due() == 0
+    assert queue.pending_count() == 3
+    fail = False
+    assert queue.flush_if_due() == 0
+    now += 6 * 60 * 60
+    assert queue.flush_if_due() == 3
+    assert submitted[-1] == ["e", "f", "g"]
+
+
+def test_indexnow_queue_chunks(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr("jako.indexnow.MAX_URLS_PER_REQUEST", 2)
+    submitted = []
+    queue = IndexNowQueue(tmp_path / "indexnow.sqlite3", submit=submitted.append)
+    queue.add(["a", "b", "c"])
+    assert queue.flush() == 3
+    assert submitted == [["a", "b"], ["c"]]
@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+from jako.llm import EchoClient, _estimate_tokens, create_backend
+from jako.ratelimit import AdaptiveLimiter
+
+
+def generate(client: EchoClient, prompt: str):
+    return asyncio.run(client.agenerate(
+        model=client.default_model,
+        prompt=prompt,
+        system_instruction="",
+        max_output_tokens=100,
+        temperature=0,
+        cache=None,
+    ))
+
+
+def test_echo_client_retries_stub_errors(monkeypatch, char_counter):
+    delays = []
+    monkeypatch.setattr("jako.llm.backoff_delay", lambda attempt: delays.append(attempt) or 0)
+    limiter = AdaptiveLimiter(max_concurrency=8)
+    client = EchoClient(error_rate=0.5, seed=4, echo_until="\n\n", limiter=limiter)
+
+    r = generate(client, "<p>本文</p>\n\ninstruction")
+    assert r.text == "<p>本文</p>" and r.complete
+    # retried after the stub's failures
+    assert delays == list(range(len(delays))) and delays
+
+    failing = EchoClient(error_rate=1, limiter=limiter)
+    with pytest.raises(Exception, match="retry failed"):
+        generate(failing, "prompt")
+
+
+def test_create_backend():
+    assert isinstance(create_backend("echo"), EchoClient)
+    with pytest.raises(ValueError, match="unknown LLM backend: nope"):
+        create_backend("nope")
+
+
+def test_estimate_tokens(char_counter):
+    assert _estimate_tokens("<p>本文</p>") == 9
+    assert _estimate_tokens([{"role": "system", "content": "ab"}, {"role": "user", "content": "本文"}]) == 4
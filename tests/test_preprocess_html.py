@@ -1,7 +1,8 @@
+import json
 from pathlib import Path
 import pytest
 from bs4 import BeautifulSoup
-from jako.preprocess_html import preprocess_html, recover_start_end_tags, restore_html, split_html_chunks, split_mediawiki_html_sections, strip_broken_tag
+from jako.preprocess_html import BrokenHtmlError, RestoreInfo, TagMismatchError, globalize_node_ids, iter_preprocess_split_html, localize_node_ids, preprocess_html, preprocess_split_html, recover_start_end_tags, restore_html, split_html_chunks, split_mediawiki_html_sections, strip_broken_tag, validate_chunk
 
 
 def test_split_html_chunks():
@@ -55,3 +56,94 @@ def test_recover_start_end_tags():
     assert recover_start_end_tags("<section>hi", "<section>hi</section>") == "<section>hi"
     assert recover_start_end_tags("<tr>\n<td>hi</td>\n</tr>", "<table><tr><td>hi</td></tr></table>") == "<tr>\n<td>hi</td>\n</tr>"
     assert recover_start_end_tags("<title>title</title>hi", "<!DOCTYPE html>\n<html>\n<head>\n<title>title</title>\n</head>\n<body>\nhi</body></html>") == "<title>title</title>hi"
+
+
+def test_validate_chunk():
+    original = '<p id="1">foo <a id="2">bar</a> <b id="3">baz</b></p>'
+    validate_chunk(original, '<p id="1">푸 <a id="2">바</a> <b id="3">바즈</b></p>')
+    validate_chunk(original, '<p id="1">푸 <a id="2">바</a> 바즈</p>')
+    with pytest.raises(TagMismatchError):
+        validate_chunk(original, '<p id="1">푸 <b id="2">바</b> <b id="3">바즈</b></p>')
+    with pytest.raises(BrokenHtmlError):
+        validate_chunk(original, '<p id="1">푸 <a id="2">바</a> <b id="4">바즈</b></p>')
+    validate_chunk('<tr id="1"><b id="2">foo</b></tr>', '<tr id="1"><td id="2"><b id="2">푸</b></td></tr>')
+
+
+def test_preprocess_split_html_length():
+    sample_path = Path(__file__).parent / "resources" / "mediawiki_sample.html"
+    html = sample_path.read_text()
+    chunks, _ = preprocess_split_html(html, "title", 4096)
+    # a coarser length function gives fewer, longer chunks
+    token_chunks, _ = preprocess_split_html(html, "title", 4096, length=lambda s: len(s) // 4)
+    assert len(token_chunks) < len(chunks)
+    assert "".join(token_chunks) == "".join(chunks)
+
+
+@pytest.mark.parametrize("keep_cite_ref_a", [True, False])
+def test_preprocess_split_html_golden(keep_cite_ref_a: bool):
+    # generated with the original parse -> serialize -> parse implementation
+    resources_path = Path(__file__).parent / "resources"
+    golden = json.loads((resources_path / "mediawiki_sample.golden.json").read_text())
+    expected = golden["keep_cite_ref_a" if keep_cite_ref_a else "unwrap_cite_ref_a"]
+    chunks, restore_info = preprocess_split_html(
+        (resources_path / "mediawiki_sample.html").read_text(),
+        "タイトル",
+        1024,
+        keep_cite_ref_a=keep_cite_ref_a,
+    )
+    assert chunks == expected["chunks"]
+    assert restore_info.model_dump(mode="json") == expected["restore_info"]
+
+
+@pytest.mark.parametrize("keep_cite_ref_a", [True, False])
+def test_iter_preprocess_split_html(keep_cite_ref_a: bool):
+    sample_path = Path(__file__).parent / "resources" / "mediawiki_sample.html"
+    html = sample_path.read_text()
+    sections = list(iter_preprocess_split_html(html, "title", 1024, keep_cite_ref_a=keep_cite_ref_a))
+    assert len(sections) == 7 + 3  # sections + wrapper start/end tags + metadata tags
+
+    node_ids = [node_id for section in sections if section.restore_info for node_id in section.restore_info.attrs]
+    assert len(node_ids) == len(set(node_ids))
+
+    restored = ""
+    for section in sections:
+        if section.restore_info is None:
+            restored += section.source
+        else:
+            restored += restore_html("".join(section.chunks), section.restore_info)[0]
+    chunks, restore_info = preprocess_split_html(html, "title", 1024, keep_cite_ref_a=keep_cite_ref_a)
+    expected, _title = restore_html("".join(chunks), restore_info)
+    # the same HTML as restoring the whole page, up to whitespace between the top-level tags
+    assert "".join(restored.split()) == "".join(expected.split())
+
+    assert len(list(iter_preprocess_split_html("<p>not mediawiki</p>", "title", 1024))) == 1
+
+
+def test_restore_info_bytes():
+    sample_path = Path(__file__).parent / "resources" / "mediawiki_sample.html"
+    chunks, restore_info = preprocess_split_html(sample_path.read_text(), "title", 1024)
+    loaded = RestoreInfo.from_bytes(restore_info.to_bytes())
+    assert loaded.model_dump() == restore_info.model_dump()
+    assert restore_html("".join(chunks), loaded) == restore_html("".join(chunks), restore_info)
+    # restoring doesn't consume the attrs
+    assert restore_html("".join(chunks), loaded) == restore_html("".join(chunks), restore_info)
+
+
+def test_localize_node_ids():
+    navbox = '<div class="navbox"><a href="/wiki/A">A</a><b>B</b></div>'
+    chunks = [
+        preprocess_split_html(prefix + navbox, "", 50)[0][-1]
+        for prefix in ("", '<p><a href="/wiki/C">C</a></p>')
+    ]
+    assert chunks[0] != chunks[1]
+    local_chunks = [localize_node_ids(chunk) for chunk in chunks]
+    assert local_chunks[0][0] == local_chunks[1][0] == '<div id="0"><a id="1">A</a><b id="2">B</b></div>'
+    for chunk, (local_chunk, node_ids) in zip(chunks, local_chunks):
+        assert globalize_node_ids(local_chunk, node_ids) == chunk
+    # ids in text and other attributes are left alone
+    assert localize_node_ids('<b id="a">id="b"</b>') == ('<b id="0">id="b"</b>', ["a"])
+    assert globalize_node_ids('<a data-id="0" id="1">x</a>', ["a", "b"]) == '<a data-id="0" id="b">x</a>'
+    # ids that are not in the chunk are broken html, so that the chunk is translated again
+    with pytest.raises(BrokenHtmlError) as e:
+        globalize_node_ids('<p id="0">x\n<a id="5">y</a></p>', ["a"])
+    assert e.value.node.name == "a"
@@ -0,0 +1,31 @@
+from pathlib import Path
+
+from jako.preprocessed import read_artifact
+from jako.translate import preprocess
+
+
+def test_preprocess_artifact(tmp_path: Path, char_counter, make_page_data):
+    sample_path = Path(__file__).parent / "resources" / "mediawiki_sample.html"
+    data = make_page_data(text=sample_path.read_text())
+    artifact_path = tmp_path / "preprocessed" / "page.bin"
+
+    sections = list(preprocess(data, artifact_path))
+    assert artifact_path.exists()
+    inode = artifact_path.stat().st_ino
+    loaded = list(preprocess(data, artifact_path))
+    assert artifact_path.stat().st_ino == inode
+    assert [(s.source, s.chunks) for s in loaded] == [(s.source, s.chunks) for s in sections]
+    assert [s.restore_info.model_dump() if s.restore_info else None for s in loaded] == \
+        [s.restore_info.model_dump() if s.restore_info else None for s in sections]
+
+    # an artifact is written only once all the sections were produced
+    partial_path = tmp_path / "preprocessed" / "partial.bin"
+    next(preprocess(data, partial_path))
+    assert not partial_path.exists()
+    assert list(partial_path.parent.iterdir()) == [artifact_path]
+
+    # a new revision invalidates the artifact
+    data.page.revid = 2
+    assert read_artifact(artifact_path, {"version": 0}) is None
+    list(preprocess(data, artifact_path))
+    assert artifact_path.stat().st_ino != inode
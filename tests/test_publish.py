@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+
+import pytest
+
+from jako.publish import page_url, publish_page, publish_sitemap, safe_filename, upload_published, write_sitemaps
+from jako.source_meta import load_page_metadata
+from jako.title_index import open_title_index
+
+
+@pytest.fixture
+def write_page(tmp_path: Path, monkeypatch, make_page_data):
+    monkeypatch.chdir(tmp_path)
+    for d in ("source", "result", "publish"):
+        Path("data", d).mkdir(parents=True)
+
+    def write_page(title: str, translated_title: str, redirects: list[str] = []) -> str:
+        fname = f"{title}.json"
+        Path("data/source", fname).write_text(make_page_data(title=title, redirects=redirects).model_dump_json(by_alias=True))
+        Path("data/result", fname).write_text(json.dumps({"title": translated_title, "html": "<p></p>"}))
+        return fname
+
+    return write_page
+
+
+def test_write_sitemaps(monkeypatch, write_page):
+    monkeypatch.setattr("jako.title_index.SHARD_TARGET_URLS", 3)
+
+    publish_page(write_page("A", "가", redirects=["A2"]))
+    publish_page(write_page("B", "B"))
+    index = open_title_index()
+    assert index.shards() == {0: ["가", "A", "A2"], 1: ["B"]}
+
+    changed = write_sitemaps(index)
+    publish_dir = Path("data/publish")
+    assert changed == [publish_dir / "sitemaps/sitemap-0.xml", publish_dir / "sitemaps/sitemap-1.xml", publish_dir / "sitemap.xml"]
+    assert "https://jako.sapzil.org/sitemaps/sitemap-1.xml" in (publish_dir / "sitemap.xml").read_text()
+    assert "<loc>https://jako.sapzil.org/wiki/%EA%B0%80</loc>" in (publish_dir / "sitemaps/sitemap-0.xml").read_text()
+    assert write_sitemaps(index) == []
+
+    # re-publishing keeps the page in its shard; new pages only change the last shard
+    publish_page(write_page("C", "다"))
+    publish_page("A.json")
+    assert index.shards() == {0: ["가", "A", "A2"], 1: ["B", "다", "C"]}
+    assert write_sitemaps(index) == [publish_dir / "sitemaps/sitemap-1.xml"]
+
+
+def test_publish_sitemap_backfills_title_index(monkeypatch, write_page):
+    monkeypatch.setattr("jako.publish.s3", FakeS3())
+    # results published before the title index existed
+    for title in ("A", "B", "C"):
+        write_page(title, title)
+
+    publish_page(write_page("New", "New"))
+    assert len(open_title_index()) == 1
+    publish_sitemap()
+    sitemap = Path("data/publish/sitemaps/sitemap-0.xml").read_text()
+    assert all(page_url(title) in sitemap for title in ("A", "B", "C", "New"))
+    assert open_title_index().backfilled
+
+
+def test_load_page_metadata(write_page):
+    source_path = Path("data/source") / write_page("A", "가", redirects=["A2"])
+
+    metadata = load_page_metadata(source_path)
+    assert (metadata.title, [r.from_ for r in metadata.redirects]) == ("A", ["A2"])
+    assert Path("data/source_meta/A.json").exists()
+
+    # the sidecar is used without parsing the source
+    mtime = source_path.stat().st_mtime
+    source_path.write_text("not json")
+    os.utime(source_path, (mtime - 10, mtime - 10))
+    assert load_page_metadata(source_path) == metadata
+
+    # a newer source is read again
+    write_page("A", "가")
+    os.utime(source_path, (mtime + 10, mtime + 10))
+    assert load_page_metadata(source_path).redirects == []
+
+
+class FakeS3:
+    def __init__(self, objects: dict[str, bytes] | None = None):
+        self.objects = dict(objects or {})
+        self.puts = []
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes):
+        with self.lock:
+            self.objects[Key] = Body
+            self.puts.append(Key)
+        return {"ETag": f'"{hashlib.md5(Body).hexdigest()}"'}
+
+    def get_paginator(self, name: str):
+        assert name == "list_objects_v2"
+        objects = self.objects
+
+        class Paginator:
+            def paginate(self, Bucket: str):
+                yield {"Contents": [{"Key": key, "ETag": f'"{hashlib.md5(body).hexdigest()}"'} for key, body in objects.items()]}
+
+        return Paginator()
+
+
+def test_upload_published(write_page):
+    publish_dir = Path("data/publish")
+
+    publish_page(write_page("A", "가", redirects=["A2"]))
+    publish_page(write_page("B", "B"))
+    # already in the bucket with the same content
+    s3 = FakeS3({"B.json": (publish_dir / "B.json").read_bytes()})
+    paths = sorted(publish_dir.glob("*.json"))
+    assert sorted(upload_published(paths, client=s3)) == ["A.json", "A2.json", "가.json"]
+    assert upload_published(paths, client=s3) == []
+
+    # re-translating a page only uploads the page, not its redirects
+    mtime = (publish_dir / "A.json").stat().st_mtime_ns
+    Path("data/result/A.json").write_text(json.dumps({"title": "가", "html": "<p>new</p>"}))
+    info = publish_page("A.json")
+    assert (publish_dir / "A.json").stat().st_mtime_ns == mtime
+    assert upload_published([publish_dir / safe_filename(t) for t in info.all_titles], client=s3) == ["가.json"]
+    assert b"<p>new</p>" in s3.objects["가.json"]
+
+
+def test_publish_page_skips_unchanged_results(monkeypatch, write_page):
+    rendered = []
+    monkeypatch.setattr("jako.publish.fix_cite_ref_a", lambda html: rendered.append(html) or html)
+
+    publish_page(write_page("A", "가"))
+    publish_page("A.json")
+    assert len(rendered) == 1
+
+    # a re-translated page is rendered again
+    Path("data/result/A.json").write_text(json.dumps({"title": "가", "html": "<p>new</p>"}))
+    publish_page("A.json")
+    assert rendered == ["<p></p>", "<p>new</p>"]
+    assert "<p>new</p>" in Path("data/publish/가.json").read_text()
+
+    # the published file is restored if it's missing
+    Path("data/publish/가.json").unlink()
+    publish_page("A.json")
+    assert len(rendered) == 3
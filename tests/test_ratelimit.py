@@ -0,0 +1,98 @@
+import asyncio
+from types import SimpleNamespace
+
+from google.genai.errors import APIError
+
+from jako import ratelimit
+from jako.llm import _retry_after
+from jako.ratelimit import AdaptiveLimiter, TokenBucket, backoff_delay
+
+
+def test_adaptive_limiter_bounds_in_flight():
+    limiter = AdaptiveLimiter(max_concurrency=3)
+    in_flight = 0
+    max_in_flight = 0
+
+    async def request():
+        nonlocal in_flight, max_in_flight
+        async with limiter.slot():
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+
+    async def run():
+        await asyncio.gather(*(request() for _ in range(10)))
+
+    asyncio.run(run())
+    assert max_in_flight == 3
+
+
+def test_adaptive_limiter_window():
+    limiter = AdaptiveLimiter(max_concurrency=8, min_concurrency=1)
+    limiter.on_throttled()
+    assert limiter.window == 4
+    limiter.on_throttled()  # same congestion event
+    assert limiter.window == 4
+    for _ in range(5):
+        limiter.on_success()
+    assert limiter.window == 5
+
+
+def test_token_bucket(monkeypatch):
+    now = 0.0
+    sleeps = []
+
+    async def sleep(delay):
+        nonlocal now
+        sleeps.append(delay)
+        now += delay
+
+    monkeypatch.setattr(ratelimit, "time", SimpleNamespace(monotonic=lambda: now))
+    monkeypatch.setattr(ratelimit, "asyncio", SimpleNamespace(sleep=sleep))
+    bucket = TokenBucket(per_minute=60, capacity=2)
+
+    async def run():
+        # a full bucket lets a burst through
+        await bucket.acquire()
+        await bucket.acquire()
+        assert sleeps == []
+        # then waits for the refill at 1/s
+        await bucket.acquire()
+        assert sleeps == [1]
+        # more than the capacity waits only for a full bucket
+        await bucket.acquire(5)
+        assert sleeps == [1, 2]
+        # idle time refills no more than the capacity
+        await sleep(100)
+        await bucket.acquire(2)
+        await bucket.acquire()
+        assert sleeps == [1, 2, 100, 1]
+
+    asyncio.run(run())
+
+
+def test_retry_after():
+    retry_info = {"error": {"details": [
+        {"@type": "type.googleapis.com/google.rpc.ErrorInfo", "reason": "RATE_LIMIT_EXCEEDED"},
+        {"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "13s"},
+    ]}}
+    assert _retry_after(APIError(429, retry_info)) == 13
+    # the header takes precedence
+    assert _retry_after(APIError(429, retry_info, SimpleNamespace(headers={"retry-after": "7"}))) == 7
+    assert _retry_after(APIError(429, retry_info, SimpleNamespace(headers={"retry-after": "soon"}))) == 13
+    assert _retry_after(APIError(503, {"error": {"details": [{"retryDelay": "1.5s"}]}})) == 1.5
+    assert _retry_after(APIError(503, {"error": {"message": "overloaded"}})) is None
+    assert _retry_after(APIError(503, {"error": {"details": [{"retryDelay": "soon"}]}})) is None
+
+
+def test_backoff_delay(monkeypatch):
+    for attempt in range(10):
+        assert 0 <= backoff_delay(attempt, base=1, cap=60) <= min(60, 2 ** attempt)
+
+    # full jitter up to the exponential bound, capped
+    monkeypatch.setattr(ratelimit, "random", SimpleNamespace(uniform=lambda a, b: (a, b)))
+    assert backoff_delay(0) == (0, 2)
+    assert backoff_delay(3) == (0, 16)
+    assert backoff_delay(10) == (0, 120)
+    assert backoff_delay(3, base=1, cap=5) == (0, 5)
@@ -0,0 +1,237 @@
+import asyncio
+from http.server import BaseHTTPRequestHandler
+import json
+from pathlib import Path
+import threading
+import time
+import urllib.parse
+
+import pytest
+
+from jako.models.page import PageData
+from jako.scrape import MediaWikiClient, adownload_pages, aiter_query_pages, crawl_category, pack_titles
+
+LINKS = [f"リンク{i}" for i in range(45)]
+
+
+class FakeMediaWikiHandler(BaseHTTPRequestHandler):
+    requests: list[dict] = []
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+    # the first query is throttled
+    throttle = True
+
+    def do_GET(self):
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+        cls = type(self)
+        with cls.lock:
+            cls.requests.append(params)
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+            throttle, cls.throttle = cls.throttle, False
+        try:
+            time.sleep(0.02)
+            if throttle:
+                self.send_response(429)
+                self.send_header("retry-after", "0")
+                self.end_headers()
+                return
+            self._send(self._handle(params))
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def _handle(self, params: dict) -> dict:
+        if params["action"] == "parse":
+            title = params["page"]
+            return {"parse": {
+                "title": title,
+                "text": f"<p>{title}</p>",
+                "pageid": 1,
+                "revid": 10,
+                "langlinks": [],
+                "links": [{"ns": 0, "title": link, "exists": True} for link in LINKS],
+            }}
+        titles = params["titles"].split("|")
+        if params["prop"] == "info":
+            pages = [{"pageid": i, "ns": 0, "title": t, "touched": "2025-01-01T00:00:00Z", "lastrevid": 10} for i, t in enumerate(titles)]
+        else:
+            pages = [
+                {"pageid": i, "ns": 0, "title": t, "langlinks": [{"lang": "ko", "title": f"{t}(ko)"}]}
+                for i, t in enumerate(titles)
+            ]
+        return {"batchcomplete": True, "query": {"pages": pages}}
+
+    def _send(self, data: dict):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def fake_mediawiki_server(http_server):
+    return f"{http_server(FakeMediaWikiHandler)}/w/api.php"
+
+
+def test_download_pages(tmp_path: Path, monkeypatch, fake_mediawiki_server):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("jako.scrape.backoff_delay", lambda attempt, base, cap: 0)
+    client = MediaWikiClient(fake_mediawiki_server, max_concurrency=3, requests_per_second=1000)
+    titles = [f"ページ{i}" for i in range(5)]
+
+    asyncio.run(adownload_pages(titles, client=client))
+
+    for title in titles:
+        data = PageData.model_validate_json((tmp_path / "data" / "source" / f"{title}.json").read_text())
+        assert data.page.title == title
+        assert [link.title for link in data.links_langlinks] == LINKS
+        assert data.links_langlinks[0].langlinks[0].title == "リンク0(ko)"
+
+    assert 1 < FakeMediaWikiHandler.max_in_flight <= 3
+    # langlinks of the links are stored once and shared by the other pages
+    langlinks_requests = [r for r in FakeMediaWikiHandler.requests if r.get("prop") == "langlinks"]
+    assert sum(len(r["titles"].split("|")) for r in langlinks_requests) < len(LINKS) * len(titles)
+
+    # existing pages are skipped
+    count = len(FakeMediaWikiHandler.requests)
+    asyncio.run(adownload_pages(titles, client=client))
+    assert all(r["action"] == "query" and r["prop"] == "info" for r in FakeMediaWikiHandler.requests[count:])
+
+
+class LaggedMediaWikiHandler(BaseHTTPRequestHandler):
+    requests: list[dict] = []
+
+    def do_GET(self):
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+        type(self).requests.append(params)
+        if len(type(self).requests) == 1:
+            data = {"error": {"code": "maxlag", "info": "Waiting for a database server: 6 seconds lagged"}}
+        else:
+            data = {"batchcomplete": True}
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("retry-after", "0")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_call_retries_maxlag(monkeypatch, http_server):
+    monkeypatch.setattr("jako.scrape.backoff_delay", lambda attempt, base, cap: 0)
+    client = MediaWikiClient(f"{http_server(LaggedMediaWikiHandler)}/w/api.php", requests_per_second=1000)
+    assert client.call({"action": "query"}) == {"batchcomplete": True}
+    assert [r["maxlag"] for r in LaggedMediaWikiHandler.requests] == ["5", "5"]
+
+
+def test_pack_titles():
+    titles = [f"t{i}" for i in range(120)]
+    assert [len(batch) for batch in pack_titles(titles, 50)] == [50, 50, 20]
+    # percent-encoded bytes count towards the URL limit
+    long_titles = ["あ" * 100] * 10
+    batches = list(pack_titles(long_titles, 50, max_bytes=2000))
+    assert [len(batch) for batch in batches] == [2, 2, 2, 2, 2]
+    assert list(pack_titles([], 50)) == []
+
+
+class ScriptedClient:
+    def __init__(self, responses: list[dict]):
+        self.responses = responses
+        self.params = []
+
+    async def acall(self, params: dict) -> dict:
+        self.params.append(dict(params))
+        return self.responses[len(self.params) - 1]
+
+
+def test_aiter_query_pages():
+    client = ScriptedClient([
+        {"continue": {"llcontinue": "1|ko"}, "query": {"pages": [
+            {"title": "A", "langlinks": [{"lang": "ko", "title": "가"}]},
+            {"title": "B"},
+        ]}},
+        {"batchcomplete": True, "continue": {"gcmcontinue": "x"}, "query": {"pages": [
+            {"title": "A", "langlinks": [{"lang": "ko", "title": "가2"}]},
+            {"title": "B", "langlinks": [{"lang": "ko", "title": "나"}]},
+        ]}},
+        {"batchcomplete": True, "query": {"pages": [{"title": "C"}]}},
+    ])
+
+    async def collect():
+        result = []
+        async for page in aiter_query_pages({"action": "query"}, client):
+            # pages are yielded as soon as their batch is complete
+            result.append((len(client.params), page))
+        return result
+
+    result = asyncio.run(collect())
+    assert result == [
+        (2, {"title": "A", "langlinks": [{"lang": "ko", "title": "가"}, {"lang": "ko", "title": "가2"}]}),
+        (2, {"title": "B", "langlinks": [{"lang": "ko", "title": "나"}]}),
+        (3, {"title": "C"}),
+    ]
+    assert client.params[1]["llcontinue"] == "1|ko"
+    assert client.params[2]["gcmcontinue"] == "x"
+
+
+class FakeCategoryClient:
+    # Category:A -> pages 1, 2 and Category:B; Category:B -> pages 2, 3 and Category:A, C; Category:C -> page 4
+    members = {
+        "Category:A": [[(0, "1"), (14, "Category:B")], [(0, "2")]],
+        "Category:B": [[(0, "2"), (0, "3"), (14, "Category:A"), (14, "Category:C")]],
+        "Category:C": [[(0, "4")]],
+    }
+
+    def __init__(self, fail_after: int | None = None):
+        self.calls = []
+        self.fail_after = fail_after
+
+    def call(self, params: dict) -> dict:
+        if self.fail_after is not None and len(self.calls) == self.fail_after:
+            raise ConnectionError("interrupted")
+        self.calls.append(params)
+        pages = self.members[params["cmtitle"]]
+        i = int(params.get("cmcontinue", 0))
+        members = [
+            {"ns": ns, "title": title}
+            for ns, title in pages[i]
+            if ns == 0 or "subcat" in params["cmtype"]
+        ]
+        data = {"query": {"categorymembers": members}}
+        if i + 1 < len(pages):
+            data["continue"] = {"cmcontinue": str(i + 1), "continue": "-||"}
+        return data
+
+
+def test_crawl_category(tmp_path: Path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data" / "result").mkdir(parents=True)
+    (tmp_path / "data" / "result" / "3.json").write_text("{}")
+
+    assert list(crawl_category("A", max_depth=0, client=FakeCategoryClient())) == ["1", "2"]
+    assert list(crawl_category("A", max_depth=1, client=FakeCategoryClient())) == ["1", "2"]
+    assert list(crawl_category("A", max_depth=2, client=FakeCategoryClient())) == ["1", "2", "4"]
+
+    # resume an interrupted crawl
+    state_path = tmp_path / "crawl.json"
+    titles = []
+    try:
+        for title in crawl_category("A", max_depth=2, state_path=state_path, client=FakeCategoryClient(fail_after=2)):
+            titles.append(title)
+    except ConnectionError:
+        pass
+    assert titles == ["1", "2"]
+    assert state_path.exists()
+    client = FakeCategoryClient()
+    assert list(crawl_category("A", max_depth=2, state_path=state_path, client=client)) == ["4"]
+    assert [params["cmtitle"] for params in client.calls] == ["Category:B", "Category:C"]
+    assert not state_path.exists()
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+from jako.cache import Cache
+from jako.llm import Completion, EchoClient
+from jako.ratelimit import AdaptiveLimiter
+from jako.translate import TRANSLATE_INSTRUCTION, _translate_chunks, process, result_path_for, result_sections_path_for
+
+
+class CountingEchoClient(EchoClient):
+    def __init__(self):
+        super().__init__(echo_until=TRANSLATE_INSTRUCTION, limiter=AdaptiveLimiter(max_concurrency=4))
+        self.calls = 0
+
+    async def agenerate(self, **kwargs):
+        self.calls += 1
+        return await super().agenerate(**kwargs)
+
+
+def test_process_refresh(tmp_path: Path, monkeypatch, char_counter, make_page_data):
+    monkeypatch.chdir(tmp_path)
+    Path("data/result").mkdir(parents=True)
+    html = (Path(__file__).parent / "resources" / "mediawiki_sample.html").read_text()
+    source_path = tmp_path / "page.json"
+
+    def write_source(text: str, revid: int):
+        source_path.write_text(make_page_data(text=text, revid=revid).model_dump_json(by_alias=True))
+
+    write_source(html, 1)
+    client = CountingEchoClient()
+    asyncio.run(process(source_path, client=client))
+    full_calls = client.calls
+
+    # nothing changed
+    client.calls = 0
+    asyncio.run(process(source_path, client=client, refresh=True))
+    assert client.calls == 0
+
+    # only the changed section is translated again
+    write_source(html.replace("あらすじ</h2>", "あらすじ（改）</h2>"), 2)
+    asyncio.run(process(source_path, client=client, refresh=True))
+    assert 0 < client.calls < full_calls
+    refreshed = json.loads(result_path_for(source_path).read_text())
+
+    asyncio.run(process(source_path, overwrite=True, client=client))
+    assert json.loads(result_path_for(source_path).read_text()) == refreshed
+    assert "あらすじ（改）" in refreshed["html"]
+
+    # results from before the sections sidecar existed
+    result_sections_path_for(source_path).unlink()
+    client.calls = 0
+    asyncio.run(process(source_path, client=client, refresh=True))
+    assert client.calls == 0
+    mtime = result_path_for(source_path).stat().st_mtime
+    os.utime(source_path, (mtime + 10, mtime + 10))
+    asyncio.run(process(source_path, client=client, refresh=True))
+    assert client.calls == full_calls
+
+
+def test_failed_chunk_lets_sent_requests_finish(tmp_path: Path):
+    limiter = AdaptiveLimiter(max_concurrency=1)
+    sent = []
+
+    async def call(prompt: str):
+        async with limiter.slot():
+            sent.append(prompt)
+            await asyncio.sleep(0.05)
+            return prompt
+
+    class Client:
+        default_model = fallback_model = "model"
+
+        async def agenerate(self, *, model, prompt, cache, **kwargs):
+            if prompt == "fail":
+                raise Exception("failed")
+            text = await cache.wrap("scope", call, lambda x: x, lambda x: x)(prompt)
+            return Completion(text=text, finish_reason="STOP", complete=True)
+
+    cache = Cache(tmp_path / "1.json")
+    chunk_args = [
+        {"chunk": chunk, "node_ids": [], "model": "model", "prompt": chunk, "max_output_tokens": 100, "retry_count": 0}
+        for chunk in ("<p>sent</p>", "fail", "<p>queued</p>")
+    ]
+    with pytest.raises(Exception, match="failed"):
+        asyncio.run(_translate_chunks(Client(), cache, chunk_args))
+    # the request in flight was cached; the one waiting for a slot was never sent
+    assert sent == ["<p>sent</p>"]
+    assert cache.lookup("scope", ("<p>sent</p>",), {}, lambda x: x) == ("<p>sent</p>", True)
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import os
+from pathlib import Path
+from types import SimpleNamespace
+
+from celery.canvas import _chain
+
+os.environ.setdefault("CELERY_BROKER", "memory://")
+os.environ.setdefault("CELERY_BACKEND", "cache+memory://")
+
+from jako import worker
+
+
+def test_scrape_pages_missing_info(monkeypatch):
+    downloaded = []
+
+    async def abatch_get_page_infos(titles):
+        return {"A": {"title": "A"}, "C": {"title": "C"}}
+
+    stores = []
+
+    async def adownload_page(title, info, refresh=False, store=None):
+        downloaded.append(title)
+        stores.append(store)
+
+    closed = []
+    monkeypatch.setattr(worker, "abatch_get_page_infos", abatch_get_page_infos)
+    monkeypatch.setattr(worker, "adownload_page", adownload_page)
+    monkeypatch.setattr(worker, "open_glossary_store", lambda: SimpleNamespace(close=lambda: closed.append(True)))
+    # "b" is returned as "B" by the API
+    results = asyncio.run(worker._scrape_pages(["A", "b", "C"]))
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], KeyError)
+    assert sorted(downloaded) == ["A", "C"]
+    # one store for the batch, closed afterwards
+    assert stores[0] is stores[1] and closed == [True]
+
+
+def test_translate_batch_retries_failed_pages(tmp_path: Path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # run the enqueued chains one by one, like a worker would
+    enqueued = []
+    monkeypatch.setattr(_chain, "apply_async", lambda self, *args, **options: enqueued.append((self, options)))
+    translated = []
+    published = []
+
+    async def abatch_get_page_infos(titles):
+        return {title: {"title": title} for title in titles}
+
+    async def adownload_page(title, info, refresh=False, store=None):
+        pass
+
+    async def translate_file(input_path: Path, refresh=False, client=None, shared_cache=None):
+        title = input_path.stem
+        translated.append(title)
+        if title == "Broken" or (title == "Flaky" and translated.count(title) == 1):
+            raise Exception("broken html")
+
+    monkeypatch.setattr(worker, "abatch_get_page_infos", abatch_get_page_infos)
+    monkeypatch.setattr(worker, "adownload_page", adownload_page)
+    monkeypatch.setattr(worker, "translate_file", translate_file)
+    monkeypatch.setattr(worker, "create_client", lambda: None)
+    monkeypatch.setattr(worker, "open_shared_cache", lambda: SimpleNamespace(close=lambda: None))
+    monkeypatch.setattr(worker, "open_glossary_store", lambda: SimpleNamespace(close=lambda: None))
+    monkeypatch.setattr(worker, "publish_page", lambda fname: published.append(fname) or SimpleNamespace(
+        translated_title=Path(fname).stem, translated_redirect_title=None, redirect_titles=[],
+    ))
+    monkeypatch.setattr(worker, "upload_published", lambda paths: list(paths))
+    monkeypatch.setattr(worker, "open_indexnow_queue", lambda: SimpleNamespace(add=lambda urls: list(urls)))
+
+    worker.translate_batch(["A", "Flaky", "Broken"])
+    while enqueued:
+        pipeline, options = enqueued.pop(0)
+        try:
+            pipeline.apply()
+        except worker.PagesFailed:
+            pass
+        if enqueued:
+            assert enqueued[-1][1]["countdown"] >= 60
+
+    assert sorted(published) == ["A.json", "Flaky.json"]
+    # only the failed pages are translated again, up to MAX_PAGE_ATTEMPTS
+    assert translated.count("A") == 1
+    assert translated.count("Flaky") == 2
+    assert translated.count("Broken") == worker.MAX_PAGE_ATTEMPTS
+    failed = [json.loads(line) for line in worker.FAILED_PAGES_PATH.read_text().splitlines()]
+    assert [(f["title"], f["stage"]) for f in failed] == [("Broken", "translate")]